@@ -0,0 +1,224 @@
+"""
+Bulk processing of saved API responses (tmp/profile.YYYYMMDD_HHMMSS.json).
+
+"""
+
+import glob
+import json
+from multiprocessing import Pool
+import os
+import time
+
+from api.history import PriceHistory
+import api.parse as parse
+from api.parse import Profile
+import api.stream as stream
+
+# Saved responses of at least this many bytes have their commodities
+# streamed. Below that, json.load() is faster and the memory saved does
+# not matter.
+_streamSize = 2 << 20
+
+
+def load_profile(data):
+    '''
+    Build a profile from a saved API response. Since 4.3.0 the responses
+    are saved as a list of (profile, market, shipyard).
+    '''
+    if isinstance(data, list):
+        profile = data[0]
+        for extra in data[1:]:
+            if int(extra["id"]) == int(profile["lastStarport"]["id"]):
+                profile["lastStarport"].update(extra)
+        return profile
+    return data
+
+
+def find_files(paths):
+    '''
+    Expand directories and glob patterns into a sorted list of files.
+    '''
+    files = set()
+    for path in paths:
+        if os.path.isdir(path):
+            files.update(glob.glob(os.path.join(path, '*.json')))
+        else:
+            files.update(glob.glob(path))
+    return sorted(files)
+
+
+def process_file(path):
+    '''
+    Parse one saved API response. Returns a dict with the file size, and
+    the station data if the commander was docked.
+    '''
+    result = {
+        'file': path,
+        'bytes': os.path.getsize(path),
+        'station': None,
+    }
+    try:
+        with open(path, encoding='utf-8') as file:
+            if result['bytes'] < _streamSize:
+                data, commodities = json.load(file), None
+            else:
+                # The commodities are the bulk of a large dump, so they go
+                # straight to EDDN entries instead of into the document.
+                data, commodities = stream.load(
+                    file,
+                    'commodities',
+                    lambda items: list(parse.eddn_commodities(items))
+                )
+        profile = load_profile(data)
+        if not profile['commander']['docked']:
+            return result
+    except (ValueError, KeyError, IndexError, TypeError) as e:
+        result['error'] = str(e)
+        return result
+
+    api = Profile(profile)
+
+    # A streamed array is left empty in place. A missing one was not
+    # merged into lastStarport, a filled one came later and overrides it.
+    lastCommodities = profile['lastStarport'].get('commodities')
+    if commodities is None or lastCommodities:
+        commodities = parse.get_commodities(api)
+    elif lastCommodities is None:
+        commodities = []
+    result.update({
+        'commander': profile['commander']['name'],
+        'system': profile['lastSystem']['name'],
+        'station': profile['lastStarport']['name'],
+        'stationID': profile['lastStarport']['id'],
+        'timestamp': os.path.getmtime(path),
+        'commodities': commodities,
+        'economies': parse.get_economies(api),
+        'prohibited': list(profile['lastStarport'].get('prohibited', {}).values()),  # NOQA
+        'ships': parse.get_ships(api),
+        'modules': parse.get_modules(api),
+    })
+    return result
+
+
+class BulkImport:
+    '''
+    Parse saved API responses across a process pool and stream the
+    results of the docked ones.
+    '''
+
+    def __init__(
+        self,
+        paths,
+        jobs=None,
+        chunksize=16
+    ):
+        self.files = find_files(paths)
+        self.jobs = jobs
+        self.chunksize = chunksize
+
+        self.count = 0
+        self.docked = 0
+        self.errors = 0
+        self.bytes = 0
+        self.elapsed = 0.0
+
+    def __iter__(self):
+        start = time.time()
+        with Pool(self.jobs) as pool:
+            for result in pool.imap_unordered(
+                process_file,
+                self.files,
+                self.chunksize
+            ):
+                self.count += 1
+                self.bytes += result['bytes']
+                self.elapsed = time.time() - start
+                if 'error' in result:
+                    self.errors += 1
+                    print('Unable to parse {}: {}'.format(
+                        result['file'],
+                        result['error']
+                    ))
+                elif result['station'] is not None:
+                    self.docked += 1
+                    yield result
+        self.elapsed = time.time() - start
+
+    def report(self):
+        elapsed = self.elapsed or 1e-9
+        print(
+            'Processed {} files ({} docked, {} errors), {:.1f} MB in {:.1f}s'
+            ' ({:.1f} files/s, {:.2f} MB/s).'.format(
+                self.count,
+                self.docked,
+                self.errors,
+                self.bytes / 1e6,
+                self.elapsed,
+                self.count / elapsed,
+                self.bytes / 1e6 / elapsed,
+            )
+        )
+
+
+class JSONLSink:
+    '''
+    Write each station as one line of JSON.
+    '''
+
+    def __init__(self, filename):
+        self.file = open(filename, 'w', encoding='utf-8')
+
+    def write(self, results):
+        for result in results:
+            self.file.write(json.dumps(result, ensure_ascii=False))
+            self.file.write('\n')
+
+    def close(self):
+        self.file.close()
+
+
+class EDDNSink:
+    '''
+    Publish each station to the EDDN, or only journal it in the outbox if
+    the connection is offline.
+    '''
+
+    def __init__(self, con):
+        self.con = con
+        self.posted = 0
+        self.failed = 0
+
+    def write(self, results):
+        posted, failed, elapsed = self.con.publishBatch(
+            (result['system'], result['station'], result)
+            for result in results
+        )
+        self.posted += posted
+        self.failed += failed
+
+    def close(self):
+        if not self.con.flush():
+            self.failed += 1
+
+
+class HistorySink:
+    '''
+    Record each market in the local price history.
+    '''
+
+    def __init__(self, filename):
+        self.history = PriceHistory(filename)
+
+    def write(self, results):
+        for result in results:
+            if result['commodities']:
+                self.history.record(
+                    result['stationID'],
+                    result['system'],
+                    result['station'],
+                    result['commodities'],
+                    result['timestamp']
+                )
+
+    def close(self):
+        self.history.close()
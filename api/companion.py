@@ -3,6 +3,7 @@ Python Implementation of the Elite Dangerous Companion API
 
 """
 
+from concurrent.futures import ThreadPoolExecutor
 import getpass
 import json
 import os
@@ -10,11 +11,18 @@ import pickle
 import requests
 from requests.utils import dict_from_cookiejar
 from requests.utils import cookiejar_from_dict
-import sys
+import tempfile
 import textwrap
+import threading
 import time
 
 
+class APIError(Exception):
+    '''
+    The API answered, but not with the data we asked for.
+    '''
+
+
 class EDAPI:
     '''
     A class that handles the Frontier ED API.
@@ -32,7 +40,8 @@ class EDAPI:
         debug=False,
         cookiefile=None,
         json_file=None,
-        login=False
+        login=False,
+        concurrent=True
     ):
         '''
         Initialize
@@ -51,11 +60,23 @@ class EDAPI:
 
         self.login = login
 
+        self.concurrent = concurrent
+
+        # The concurrent starport requests can both hit the login page,
+        # only one of them may log in.
+        self._loginLock = threading.Lock()
+
+        # Time spent on each endpoint, in seconds.
+        self.timings = {}
+
+        self.opener = None
+
+        self._json_file = json_file
+
         # If json_file was given, just load that instead.
         if json_file:
-            with open(json_file) as file:
-                self.profile = json.load(file)
-                return
+            self.refresh()
+            return
 
         # if self.debug:
         #     import http.client
@@ -68,55 +89,106 @@ class EDAPI:
             'User-Agent': self._agent
         }
 
-        # Read/create the cookie jar.
+        # Read the cookie jar. It is only written back when it changed.
+        self._savedCookies = None
         if os.path.exists(self._cookiefile):
             try:
                 with open(self._cookiefile, 'rb') as h:
-                    self.opener.cookies = cookiejar_from_dict(pickle.load(h))
+                    self._savedCookies = pickle.load(h)
+                    self.opener.cookies = cookiejar_from_dict(self._savedCookies)  # NOQA
             except:
                 print('Unable to read cookie file.')
 
-        else:
-            with open(self._cookiefile, 'wb') as h:
-                pickle.dump(dict_from_cookiejar(self.opener.cookies), h)
-
         # If force login, kill the user cookie, but keep the machine token
         # intact.
         if self.login:
             self.opener.cookies.pop('CompanionApp', None)
 
-        # Grab the commander profile
-        response = self._getURI('profile')
+        self.refresh()
+
+    def refresh(self):
+        '''
+        Grab the commander profile, plus the market and shipyard data if
+        docked. Can be called again to poll with the same session.
+        '''
+        self.timings = {}
+
+        if self._json_file:
+            with open(self._json_file) as file:
+                self.profile = json.load(file)
+            return
+
         try:
-            self.profile = response.json()
+            # Grab the commander profile
+            start = time.time()
+            response = self._getURI('profile')
+            self.timings['profile'] = time.time() - start
+            try:
+                self.profile = response.json()
+            except:
+                if self.debug:
+                    print('   URL:', response.url)
+                    print('status:', response.status_code)
+                    print(' text:', response.text)
+                raise APIError(
+                    "Unable to parse JSON response for /profile!"
+                    "\nTry to relogin with the --login option."
+                    "\n{}".format("" if self.debug else "\nTry with --debug and report this.")  # NOQA
+                )
+
+            # Grab the market and shipyard data (if docked)
+            if self.profile['commander']['docked']:
+                self._getStarportData()
+        finally:
+            # Save the cookies once for the whole session.
+            self._saveCookies()
+
+        if self.debug:
+            for dataUrl, elapsed in self.timings.items():
+                print('{:>8}: {:.3f}s'.format('/'+dataUrl, elapsed))
+
+    def _getStarportData(self):
+        '''
+        Grab the market and shipyard data and merge it into lastStarport.
+        '''
+        dataUrls = ("market", "shipyard")
+
+        if self.concurrent:
+            # Both requests only depend on the profile, so issue them at the
+            # same time and merge in a fixed order afterwards.
+            with ThreadPoolExecutor(max_workers=len(dataUrls)) as executor:
+                futures = [
+                    executor.submit(self._getJSON, dataUrl)
+                    for dataUrl in dataUrls
+                ]
+                results = [future.result() for future in futures]
+        else:
+            results = [self._getJSON(dataUrl) for dataUrl in dataUrls]
+
+        for jsonData in results:
+            if int(jsonData["id"]) == int(self.profile["lastStarport"]["id"]):  # NOQA
+                self.profile["lastStarport"].update(jsonData)
+
+    def _getJSON(self, dataUrl):
+        '''
+        Perform a GET on a data URI and return the decoded JSON.
+        '''
+        start = time.time()
+        response = self._getURI(dataUrl)
+        self.timings[dataUrl] = time.time() - start
+        try:
+            jsonData = response.json()
+            int(jsonData["id"])
         except:
             if self.debug:
                 print('   URL:', response.url)
                 print('status:', response.status_code)
-                print(' text:', response.text)
-            sys.exit(
-                "Unable to parse JSON response for /profile!"
-                "\nTry to relogin with the --login option."
-                "\n{}".format("" if self.debug else "\nTry with --debug and report this.")  # NOQA
+                print('  text:', response.text)
+            raise APIError(
+                "Unable to parse JSON response for /{}!"
+                "{}".format(dataUrl, "" if self.debug else "\nTry with --debug and report this.")  # NOQA
             )
-
-        # Grab the market and shipyard data (if docked)
-        if self.profile['commander']['docked']:
-            for dataUrl in ("market", "shipyard"):
-                response = self._getURI(dataUrl)
-                try:
-                    jsonData = response.json()
-                    if int(jsonData["id"]) == int(self.profile["lastStarport"]["id"]):  # NOQA
-                        self.profile["lastStarport"].update(jsonData)
-                except:
-                    if self.debug:
-                        print('   URL:', response.url)
-                        print('status:', response.status_code)
-                        print('  text:', response.text)
-                    sys.exit(
-                        "Unable to parse JSON response for /{}!"
-                        "{}".format(dataUrl, "" if self.debug else "\nTry with --debug and report this.")  # NOQA
-                    )
+        return jsonData
 
     def _getBasicURI(self, uri, values=None):
         '''
@@ -139,13 +211,45 @@ class EDAPI:
             print('Final URL:', response.url)
             print(dict_from_cookiejar(self.opener.cookies))
 
-        # Save the cookies.
-        with open(self._cookiefile, 'wb') as h:
-            pickle.dump(dict_from_cookiejar(self.opener.cookies), h)
-
         # Return the response object.
         return response
 
+    def _saveCookies(self):
+        '''
+        Write the cookie jar to disk, but only if it changed since it was
+        last read or written.
+        '''
+        cookies = dict_from_cookiejar(self.opener.cookies)
+        if cookies == self._savedCookies:
+            return False
+
+        if self.debug:
+            print('Saving cookies to:', self._cookiefile)
+
+        # Write to a temporary file next to the real one and rename it over
+        # the top, so a concurrent reader never sees a half written file.
+        cookiedir = os.path.dirname(os.path.abspath(self._cookiefile))
+        fd, tmpname = tempfile.mkstemp(dir=cookiedir, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as h:
+                pickle.dump(cookies, h)
+            os.replace(tmpname, self._cookiefile)
+        except:
+            os.unlink(tmpname)
+            raise
+
+        self._savedCookies = cookies
+        return True
+
+    def close(self):
+        '''
+        Save the cookies and close the HTTP session.
+        '''
+        if self.opener is None:
+            return
+        self._saveCookies()
+        self.opener.close()
+
     def _getURI(self, uri, values=None):
         '''
         Perform a GET/POST and try to login if needed.
@@ -156,11 +260,14 @@ class EDAPI:
         response = self._getBasicURI(uri, values=values)
 
         if 'Password' in str(response.text):
-            self._doLogin()
+            # The other request may have logged in meanwhile, _doLogin()
+            # then finds the cookies valid and returns.
+            with self._loginLock:
+                self._doLogin()
             response = self._getBasicURI(uri, values=values)
 
         if 'Password' in str(response.text):
-            sys.exit(textwrap.fill(textwrap.dedent("""\
+            raise APIError(textwrap.fill(textwrap.dedent("""\
                 Something went terribly wrong. The login credentials
                 appear correct, but we are being denied access. Sometimes the
                 API is slow to update, so if you are authenticating for the
@@ -213,7 +320,7 @@ class EDAPI:
         # If we end up being redirected back to login,
         # the login failed.
         if 'Password' in str(response.text):
-            sys.exit('Login failed.')
+            raise APIError('Login failed.')
 
         # Check to see if we need to do the auth token dance.
         if str(response.url).endswith('user/confirm'):
@@ -225,5 +332,8 @@ class EDAPI:
             values['code'] = input("Code:")
             response = self._getBasicURI('user/confirm', values=values)
 
+        # Don't lose a fresh login if anything below fails.
+        self._saveCookies()
+
         # The API is sometimes very slow to update sessions. Wait a bit...
         time.sleep(2)
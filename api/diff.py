@@ -0,0 +1,119 @@
+"""
+Differences between consecutive markets of the same station.
+
+"""
+
+import json
+import os
+import tempfile
+
+
+class MarketDelta:
+    '''
+    What changed in a station market since the last snapshot. changed
+    maps a commodity name to {field: (old, new)}.
+    '''
+
+    fields = (
+        'buyPrice',
+        'sellPrice',
+        'meanPrice',
+        'stock',
+        'stockBracket',
+        'demand',
+        'demandBracket',
+    )
+
+    def __init__(self, stationID, added, removed, changed, first=False):
+        self.stationID = stationID
+        self.added = added
+        self.removed = removed
+        self.changed = changed
+        self.first = first
+
+    def __bool__(self):
+        return bool(self.first or self.added or self.removed or self.changed)
+
+    def names(self):
+        '''
+        Names of the commodities that are new or changed.
+        '''
+        return set(self.added) | set(self.changed)
+
+    def __str__(self):
+        if self.first:
+            return 'New market, {} commodities.'.format(len(self.added))
+        return '{} added, {} removed, {} changed.'.format(
+            len(self.added),
+            len(self.removed),
+            len(self.changed)
+        )
+
+    @classmethod
+    def compute(cls, stationID, old, new):
+        '''
+        Compare two lists of EDDN commodity entries. old may be None if the
+        station was not seen before.
+        '''
+        newByName = {commodity['name']: commodity for commodity in new}
+        if old is None:
+            return cls(stationID, sorted(newByName), [], {}, first=True)
+
+        oldByName = {commodity['name']: commodity for commodity in old}
+        added = sorted(newByName.keys() - oldByName.keys())
+        removed = sorted(oldByName.keys() - newByName.keys())
+        changed = {}
+        for name in newByName.keys() & oldByName.keys():
+            before, after = oldByName[name], newByName[name]
+            fields = {
+                field: (before.get(field), after.get(field))
+                for field in cls.fields
+                if before.get(field) != after.get(field)
+            }
+            if fields:
+                changed[name] = fields
+        return cls(stationID, added, removed, changed)
+
+
+class MarketCache:
+    '''
+    The last market seen for each station, keyed by lastStarport.id and
+    kept in a JSON file.
+    '''
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.markets = {}
+
+        if os.path.exists(self.filename):
+            try:
+                with open(self.filename) as h:
+                    self.markets = json.load(h)
+            except ValueError:
+                print('Unable to read market cache file.')
+
+    def diff(self, stationID, commodities):
+        '''
+        Compare a market with the cached one for the station.
+        '''
+        return MarketDelta.compute(
+            stationID,
+            self.markets.get(str(stationID)),
+            commodities
+        )
+
+    def update(self, stationID, commodities):
+        '''
+        Cache a market and save the file.
+        '''
+        self.markets[str(stationID)] = commodities
+
+        cachedir = os.path.dirname(os.path.abspath(self.filename))
+        fd, tmpname = tempfile.mkstemp(dir=cachedir, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'w') as h:
+                json.dump(self.markets, h)
+            os.replace(tmpname, self.filename)
+        except:
+            os.unlink(tmpname)
+            raise
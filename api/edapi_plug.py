@@ -4,6 +4,7 @@
 # ----------------------------------------------------------------
 
 import cache
+from concurrent.futures import ThreadPoolExecutor, wait
 import csvexport
 from datetime import datetime, timezone
 import getpass
@@ -17,8 +18,11 @@ import random
 import requests
 from requests.utils import dict_from_cookiejar
 from requests.utils import cookiejar_from_dict
+import sqlite3
 import sys
+import tempfile
 import textwrap
+import threading
 import time
 import mapping
 import transfers
@@ -57,7 +61,8 @@ class EDAPI:
         debug=False,
         cookiefile=None,
         json_file=None,
-        login=False
+        login=False,
+        concurrent=True
     ):
         '''
         Initialize
@@ -76,6 +81,17 @@ class EDAPI:
 
         self.login = login
 
+        self.concurrent = concurrent
+
+        # The concurrent starport requests can both hit the login page,
+        # only one of them may log in.
+        self._loginLock = threading.Lock()
+
+        # Time spent on each endpoint, in seconds.
+        self.timings = {}
+
+        self.opener = None
+
         # If json_file was given, just load that instead.
         if json_file:
             with open(json_file) as file:
@@ -93,56 +109,93 @@ class EDAPI:
             'User-Agent': self._agent
         }
 
-        # Read/create the cookie jar.
+        # Read the cookie jar. It is only written back when it changed.
+        self._savedCookies = None
         if os.path.exists(self._cookiefile):
             try:
                 with open(self._cookiefile, 'rb') as h:
-                    self.opener.cookies = cookiejar_from_dict(pickle.load(h))
+                    self._savedCookies = pickle.load(h)
+                    self.opener.cookies = cookiejar_from_dict(self._savedCookies)  # NOQA
             except:
                 print('Unable to read cookie file.')
 
-        else:
-            with open(self._cookiefile, 'wb') as h:
-                pickle.dump(dict_from_cookiejar(self.opener.cookies), h)
-
         # If force login, kill the user cookie, but keep the machine token
         # intact.
         if self.login:
             self.opener.cookies.pop('CompanionApp', None)
 
-        # Grab the commander profile
-        response = self._getURI('profile')
         try:
-            self.profile = response.json()
-            self.text    = [ response.text ]
+            # Grab the commander profile
+            start = time.time()
+            response = self._getURI('profile')
+            self.timings['profile'] = time.time() - start
+            try:
+                self.profile = response.json()
+                self.text    = [ response.text ]
+            except:
+                if self.debug:
+                    print('   URL:', response.url)
+                    print('status:', response.status_code)
+                    print('  text:', response.text)
+                sys.exit(
+                    "Unable to parse JSON response for /profile!"
+                    "\nTry to relogin with the 'login' option."
+                    "{}".format("" if self.debug else "\nTry with --debug and report this.")
+                )
+            # Grab the market and shipyard data (if docked)
+            if self.profile['commander']['docked']:
+                self._getStarportData()
+        finally:
+            # Save the cookies once for the whole session.
+            self._saveCookies()
+
+        if self.debug:
+            for dataUrl, elapsed in self.timings.items():
+                print('{:>8}: {:.3f}s'.format('/'+dataUrl, elapsed))
+
+    def _getStarportData(self):
+        '''
+        Grab the market and shipyard data and merge it into lastStarport.
+        '''
+        dataUrls = ("market", "shipyard")
+
+        if self.concurrent:
+            # Both requests only depend on the profile, so issue them at the
+            # same time and merge in a fixed order afterwards.
+            with ThreadPoolExecutor(max_workers=len(dataUrls)) as executor:
+                futures = [
+                    executor.submit(self._getJSON, dataUrl)
+                    for dataUrl in dataUrls
+                ]
+                results = [future.result() for future in futures]
+        else:
+            results = [self._getJSON(dataUrl) for dataUrl in dataUrls]
+
+        for jsonData, text in results:
+            self.text.append(text)
+            if int(jsonData["id"]) == int(self.profile["lastStarport"]["id"]):
+                self.profile["lastStarport"].update(jsonData)
+
+    def _getJSON(self, dataUrl):
+        '''
+        Perform a GET on a data URI and return the decoded JSON and raw text.
+        '''
+        start = time.time()
+        response = self._getURI(dataUrl)
+        self.timings[dataUrl] = time.time() - start
+        try:
+            jsonData = response.json()
+            int(jsonData["id"])
         except:
             if self.debug:
                 print('   URL:', response.url)
                 print('status:', response.status_code)
                 print('  text:', response.text)
             sys.exit(
-                "Unable to parse JSON response for /profile!"
-                "\nTry to relogin with the 'login' option."
-                "{}".format("" if self.debug else "\nTry with --debug and report this.")
+                "Unable to parse JSON response for /{}!"
+                "{}".format(dataUrl, "" if self.debug else "\nTry with --debug and report this.")
             )
-        # Grab the market and shipyard data (if docked)
-                if self.profile['commander']['docked']:
-            for dataUrl in ("market", "shipyard"):
-                response = self._getURI(dataUrl)
-                try:
-                    jsonData = response.json()
-                    self.text.append(response.text)
-                    if int(jsonData["id"]) == int(self.profile["lastStarport"]["id"]):
-                        self.profile["lastStarport"].update(jsonData)
-                except:
-                    if self.debug:
-                        print('   URL:', response.url)
-                        print('status:', response.status_code)
-                        print('  text:', response.text)
-                    sys.exit(
-                        "Unable to parse JSON response for /{}!"
-                    "{}".format(dataUrl, "" if self.debug else "\nTry with --debug and report this.")
-                    )
+        return jsonData, response.text
 
     def _getBasicURI(self, uri, values=None):
         '''
@@ -165,13 +218,45 @@ class EDAPI:
             print('Final URL:', response.url)
             print(dict_from_cookiejar(self.opener.cookies))
 
-        # Save the cookies.
-        with open(self._cookiefile, 'wb') as h:
-            pickle.dump(dict_from_cookiejar(self.opener.cookies), h)
-
         # Return the response object.
         return response
 
+    def _saveCookies(self):
+        '''
+        Write the cookie jar to disk, but only if it changed since it was
+        last read or written.
+        '''
+        cookies = dict_from_cookiejar(self.opener.cookies)
+        if cookies == self._savedCookies:
+            return False
+
+        if self.debug:
+            print('Saving cookies to:', self._cookiefile)
+
+        # Write to a temporary file next to the real one and rename it over
+        # the top, so a concurrent reader never sees a half written file.
+        cookiedir = os.path.dirname(os.path.abspath(self._cookiefile))
+        fd, tmpname = tempfile.mkstemp(dir=cookiedir, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as h:
+                pickle.dump(cookies, h)
+            os.replace(tmpname, self._cookiefile)
+        except:
+            os.unlink(tmpname)
+            raise
+
+        self._savedCookies = cookies
+        return True
+
+    def close(self):
+        '''
+        Save the cookies and close the HTTP session.
+        '''
+        if self.opener is None:
+            return
+        self._saveCookies()
+        self.opener.close()
+
     def _getURI(self, uri, values=None):
         '''
         Perform a GET/POST and try to login if needed.
@@ -182,7 +267,10 @@ class EDAPI:
         response = self._getBasicURI(uri, values=values)
 
         if 'Password' in str(response.text):
-            self._doLogin()
+            # The other request may have logged in meanwhile, _doLogin()
+            # then finds the cookies valid and returns.
+            with self._loginLock:
+                self._doLogin()
             response = self._getBasicURI(uri, values=values)
 
         if 'Password' in str(response.text):
@@ -251,10 +339,103 @@ class EDAPI:
             values['code'] = input("Code:")
             response = self._getBasicURI('user/confirm', values=values)
 
+        # Don't lose a fresh login if anything below fails.
+        self._saveCookies()
+
         # The API is sometimes very slow to update sessions. Wait a bit...
         time.sleep(2)
 
 
+class PublishState:
+    '''
+    Remembers a hash of the last message published for each system,
+    station and schema, so identical messages can be skipped for a while.
+    '''
+
+    def __init__(
+        self,
+        filename,
+        window=3600
+    ):
+        self.filename = filename
+        self.window = window
+        self.entries = {}
+
+        if os.path.exists(self.filename):
+            try:
+                with open(self.filename) as h:
+                    self.entries = json.load(h)
+            except ValueError:
+                print('Unable to read EDDN state file.')
+
+        # Entries older than the window can never match again.
+        now = time.time()
+        self.entries = {
+            key: entry for key, entry in self.entries.items()
+            if now - entry[1] < self.window
+        }
+        self.dirty = False
+
+    @staticmethod
+    def key(message):
+        return '|'.join((
+            message['message']['systemName'],
+            message['message']['stationName'],
+            message['$schemaRef'],
+        ))
+
+    @staticmethod
+    def digest(message):
+        # The timestamp changes every time, so leave it out.
+        payload = dict(message['message'])
+        payload.pop('timestamp', None)
+        return hashlib.sha1(
+            json.dumps(
+                payload,
+                sort_keys=True,
+                separators=(',', ':')
+            ).encode('utf8')
+        ).hexdigest()
+
+    def isDuplicate(self, message):
+        '''
+        True if the same message was published within the window.
+        '''
+        entry = self.entries.get(self.key(message))
+        if entry is None:
+            return False
+        digest, published = entry
+        return (
+            digest == self.digest(message) and
+            time.time() - published < self.window
+        )
+
+    def record(self, message):
+        '''
+        Remember a published message. The state file is only written by
+        save().
+        '''
+        self.entries[self.key(message)] = [self.digest(message), time.time()]
+        self.dirty = True
+
+    def save(self):
+        '''
+        Write the state file, if anything was recorded since the last save.
+        '''
+        if not self.dirty:
+            return
+        statedir = os.path.dirname(os.path.abspath(self.filename))
+        fd, tmpname = tempfile.mkstemp(dir=statedir, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'w') as h:
+                json.dump(self.entries, h)
+            os.replace(tmpname, self.filename)
+        except:
+            os.unlink(tmpname)
+            raise
+        self.dirty = False
+
+
 class EDDN:
     _gateways = (
         'https://eddn.edcd.io:4430/upload/',
@@ -291,7 +472,9 @@ class EDDN:
         uploaderID,
         noHash,
         softwareName,
-        softwareVersion
+        softwareVersion,
+        state=None,
+        workers=0
     ):
         # Obfuscate uploaderID
         if noHash:
@@ -300,14 +483,53 @@ class EDDN:
             self.uploaderID = hashlib.sha1(uploaderID.encode('utf-8')).hexdigest()
         self.softwareName = softwareName
         self.softwareVersion = softwareVersion
+        self.state = state
+        self._lock = threading.Lock()
+
+        # With workers, messages are posted in the background and
+        # postMessage() returns a future instead of waiting.
+        self._executor = None
+        self._futures = []
+        if workers > 0:
+            self._executor = ThreadPoolExecutor(max_workers=workers)
+
+    def flush(self, timeout=None):
+        '''
+        Wait for background posts to finish and save the publish state.
+        Returns False if any of them failed or did not finish within the
+        timeout.
+        '''
+        futures, self._futures = self._futures, []
+        ok = True
+        if futures:
+            done, pending = wait(futures, timeout=timeout)
+            ok = not pending
+            for future in done:
+                error = future.exception()
+                if error is not None:
+                    print('EDDN post failed:', error)
+                    ok = False
+            if pending:
+                print('{} EDDN posts still pending.'.format(len(pending)))
+            if self._executor is not None:
+                self._executor.shutdown(wait=False)
+
+        if self.state is not None:
+            with self._lock:
+                self.state.save()
+        return ok
 
     def postMessage(
         self,
         message,
         timestamp=0
     ):
+        if self.state is not None and self.state.isDuplicate(message):
+            print('Unchanged since the last post, skipped.')
+            return False
+
         if timestamp:
-            timestamp = datetime.fromtimestamp(timestamp).isoformat()
+            timestamp = datetime.fromtimestamp(timestamp, timezone.utc).isoformat()
         else:
             timestamp = datetime.now(timezone.utc).astimezone().isoformat()
 
@@ -328,18 +550,36 @@ class EDDN:
                 )
             )
 
+        data = json.dumps(
+            message,
+            ensure_ascii=False
+        ).encode('utf8')
+
+        if self._executor is not None:
+            future = self._executor.submit(
+                self._send, message, url, headers, data
+            )
+            self._futures.append(future)
+            return future
+
+        return self._send(message, url, headers, data)
+
+    def _send(self, message, url, headers, data):
         r = requests.post(
             url,
             headers=headers,
-            data=json.dumps(
-                message,
-                ensure_ascii=False
-            ).encode('utf8'),
+            data=data,
             verify=True
         )
 
         r.raise_for_status()
 
+        if self.state is not None:
+            with self._lock:
+                self.state.record(message)
+
+        return True
+
     def publishCommodities(
         self,
         systemName,
@@ -363,7 +603,7 @@ class EDDN:
             'commodities': commodities,
         }
 
-        self.postMessage(message, timestamp)
+        return self.postMessage(message, timestamp)
 
     def publishShipyard(
         self,
@@ -388,7 +628,7 @@ class EDDN:
             'ships': ships,
         }
 
-        self.postMessage(message, timestamp)
+        return self.postMessage(message, timestamp)
 
     def publishOutfitting(
         self,
@@ -413,7 +653,70 @@ class EDDN:
             'modules': modules,
         }
 
-        self.postMessage(message, timestamp)
+        return self.postMessage(message, timestamp)
+
+
+class FDevIDMap:
+    '''
+    mapID() of a TD FDev mapping table, memoized in a plain dict keyed by
+    (id, name). The table is only built on the first unknown key.
+    '''
+
+    def __init__(self, mappingClass, tdb, tdenv, entries):
+        self.mappingClass = mappingClass
+        self.tdb = tdb
+        self.tdenv = tdenv
+        self.entries = entries
+        self.table = None
+
+    def mapID(self, fdevID, name):
+        try:
+            return self.entries[(fdevID, name)]
+        except KeyError:
+            pass
+        if self.table is None:
+            startTime = time.time()
+            self.table = self.mappingClass(self.tdb, self.tdenv)
+            self.tdenv.DEBUG0(
+                "{} loaded in {:.3f}s",
+                self.mappingClass.__name__, time.time() - startTime
+            )
+        mapped = self.table.mapID(fdevID, name)
+        self.entries[(fdevID, name)] = mapped
+        return mapped
+
+
+class StageTimer:
+    '''
+    Log the time each stage of a plugin run takes with DEBUG0.
+    '''
+
+    def __init__(self, tdenv):
+        self.tdenv = tdenv
+        self.start = self.last = time.time()
+
+    def lap(self, stage):
+        now = time.time()
+        self.tdenv.DEBUG0("Stage {}: {:.3f}s", stage, now - self.last)
+        self.last = now
+
+    def total(self):
+        self.tdenv.DEBUG0("Run: {:.3f}s", time.time() - self.start)
+
+
+class StationRow(namedtuple('StationRow', [
+    'ID', 'dbname', 'systemName', 'lsFromStar', 'blackMarket', 'maxPadSize',
+    'market', 'shipyard', 'outfitting', 'rearm', 'refuel', 'repair',
+    'planetary',
+])):
+    '''
+    The Station columns the plugin uses, read straight from the database
+    so a run that changes nothing about the station needs no tdb.load().
+    '''
+    __slots__ = ()
+
+    def name(self):
+        return '{}/{}'.format(self.systemName.upper(), self.dbname)
 
 
 class ImportPlugin(plugins.ImportPluginBase):
@@ -424,16 +727,27 @@ class ImportPlugin(plugins.ImportPluginBase):
 
     pluginOptions = {
         'csvs': 'Merge shipyards into ShipVendor.csv.',
-        'edcd': 'Call the EDCD plugin first.',
+        'edcd': 'Call the EDCD plugin first, if the commander is docked.',
         'eddn': 'Post market, shipyard and outfitting to EDDN.',
         'name': 'Do not obfuscate commander name for EDDN submit.',
         'save': 'Save the API response (tmp/profile.YYYYMMDD_HHMMSS.json).',
         'test': 'Test the plugin with a json file (test=[FILENAME]).',
         'warn': 'Ask for station update if a API<->DB diff is encountered.',
         'login': 'Ask for login credentials.',
+        'window': 'Skip EDDN posts identical to the last one within this many seconds (window=[SECONDS], default 3600).',
+        'diff':  'Only import the changed items, and only post the market if it changed since the last import.',
+        'file':  'Import prices through a .prices file instead of writing them directly.',
     }
 
     cookieFile = "edapi.cookies"
+    eddnStateFile = "edapi.eddn"
+    marketFile = "edapi.markets"
+    fdevFile = "edapi.fdev"
+
+    fdevMappings = {
+        'items': mapping.FDEVMappingItems,
+        'ships': mapping.FDEVMappingShips,
+    }
 
     def __init__(self, tdb, tdenv):
         super().__init__(tdb, tdenv)
@@ -441,8 +755,13 @@ class ImportPlugin(plugins.ImportPluginBase):
         self.filename = self.defaultImportFile
         cookieFilePath = pathlib.Path(ImportPlugin.cookieFile)
         self.cookiePath = tdb.dataPath / cookieFilePath
+        self.eddnStatePath = tdb.dataPath / pathlib.Path(ImportPlugin.eddnStateFile)
+        self.marketPath = tdb.dataPath / pathlib.Path(ImportPlugin.marketFile)
+        self.fdevPath = tdb.dataPath / pathlib.Path(ImportPlugin.fdevFile)
+        self.stamp = None
+        self.fdevMaps = None
 
-    def askForStationData(self, system, stnName=None, station=None):
+    def askForStationData(self, station=None):
         """
         Ask for new or updated station data
         """
@@ -613,6 +932,13 @@ class ImportPlugin(plugins.ImportPluginBase):
             print(" Shipyard..:", _detail(newStation['shipyard'], tdb.marketStates))
             print(" Market....:", _detail(newStation['market'], tdb.marketStates))
 
+        return newStation
+
+    def saveStationData(self, system, stnName, station, newStation):
+        """
+        Add or update the station in the database
+        """
+        tdb, tdenv = self.tdb, self.tdenv
         exportCSV = False
         if not station:
             station = tdb.addLocalStation(
@@ -656,25 +982,315 @@ class ImportPlugin(plugins.ImportPluginBase):
             tdenv.DEBUG0("{} updated.", csvPath)
         return station
 
-    def run(self):
-        tdb, tdenv = self.tdb, self.tdenv
+    def loadMarkets(self):
+        """
+        Load the last imported item lists, keyed by lastStarport.id
+        """
+        if self.marketPath.exists():
+            try:
+                with self.marketPath.open() as marketFile:
+                    return json.load(marketFile)
+            except ValueError:
+                self.tdenv.WARN("Unable to read {}.", str(self.marketPath))
+        return {}
 
-        # first check for EDCD
-        if self.getOption("edcd"):
-            # Call the EDCD plugin
+    def saveMarkets(self, markets):
+        """
+        Save the last imported item lists
+        """
+        fd, tmpName = tempfile.mkstemp(dir=str(self.marketPath.parent), suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'w') as marketFile:
+                json.dump(markets, marketFile)
+            os.replace(tmpName, str(self.marketPath))
+        except:
+            os.unlink(tmpName)
+            raise
+
+    def dbStamp(self):
+        """
+        Modification times and sizes of the TD database and of the files
+        the cache is built from
+        """
+        tdb = self.tdb
+        paths = [tdb.dbPath]
+        for pattern in ('*.sql', '*.prices', '*.csv'):
+            paths.extend(tdb.dataPath.glob(pattern))
+        stamp = []
+        for path in sorted(paths):
             try:
-                import plugins.edcd_plug as EDCD
-            except:
-                raise plugins.PluginException("EDCD plugin not found.")
-            tdenv.NOTE("Calling the EDCD plugin.")
-            edcdPlugin = EDCD.ImportPlugin(tdb, tdenv)
-            edcdPlugin.options["csvs"] = True
-            edcdPlugin.run()
-            tdenv.NOTE("Going back to EDAPI.\n")
+                stat = path.stat()
+            except OSError:
+                continue
+            stamp.append((path.name, stat.st_mtime_ns, stat.st_size))
+        return stamp
+
+    def loadStamped(self, path, stamp):
+        """
+        Load data saved by saveStamped(), if the database stamp still
+        matches
+        """
+        if path.exists():
+            try:
+                with path.open('rb') as stampedFile:
+                    savedStamp, data = pickle.load(stampedFile)
+            except (OSError, EOFError, ValueError, pickle.UnpicklingError):
+                self.tdenv.WARN("Unable to read {}.", str(path))
+                return None
+            if savedStamp == stamp:
+                return data
+        return None
+
+    def saveStamped(self, path, data, stamp):
+        """
+        Save data together with a database stamp
+        """
+        fd, tmpName = tempfile.mkstemp(dir=str(path.parent), suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as stampedFile:
+                pickle.dump((stamp, data), stampedFile)
+            os.replace(tmpName, str(path))
+        except:
+            os.unlink(tmpName)
+            raise
+
+    def fdevMap(self, kind):
+        """
+        The memoized FDev ID mapping for 'items' or 'ships'. The cache file
+        is read on first use, the TD mapping table only on a cache miss.
+        """
+        if self.fdevMaps is None:
+            startTime = time.time()
+            self.fdevMaps = self.loadStamped(self.fdevPath, self.stamp)
+            if self.fdevMaps is None:
+                self.fdevMaps = {}
+                state = "cold"
+            else:
+                state = "warm"
+            self.tdenv.DEBUG0(
+                "FDev ID cache {} in {:.3f}s", state, time.time() - startTime
+            )
+        return FDevIDMap(
+            self.fdevMappings[kind],
+            self.tdb,
+            self.tdenv,
+            self.fdevMaps.setdefault(kind, {}),
+        )
+
+    def lookupLocation(self, sysName, stnName):
+        """
+        Find the system ID and the station row by name with two indexed
+        queries, instead of loading every system and station
+        """
+        db = self.tdb.getDB()
+        systems = db.execute(
+            """
+            SELECT system_id, name FROM System
+             WHERE name = ? COLLATE NOCASE
+            """,
+            [sysName]
+        ).fetchall()
+        if not systems:
+            raise plugins.PluginException(
+                "System '{}' unknown.".format(sysName)
+            )
+        if len(systems) > 1:
+            raise plugins.PluginException(
+                "System '{}' is ambiguous.".format(sysName)
+            )
+        sysID, sysDBName = systems[0]
+
+        row = db.execute(
+            """
+            SELECT station_id, name,
+                   ls_from_star, blackmarket, max_pad_size,
+                   market, shipyard, outfitting,
+                   rearm, refuel, repair, planetary
+              FROM Station
+             WHERE system_id = ?
+               AND name = ? COLLATE NOCASE
+            """,
+            [sysID, stnName]
+        ).fetchone()
+        if row is None:
+            return sysID, None
+        return sysID, StationRow(row[0], row[1], sysDBName, *row[2:])
+
+    @staticmethod
+    def marketDigest(eddn_market):
+        """
+        A hash of the market as posted to EDDN
+        """
+        return hashlib.sha1(
+            json.dumps(eddn_market, sort_keys=True).encode('utf8')
+        ).hexdigest()
 
-        # now load the mapping tables
-        itemMap = mapping.FDEVMappingItems(tdb, tdenv)
-        shipMap = mapping.FDEVMappingShips(tdb, tdenv)
+    def diffMarket(self, markets, stationID, itemList):
+        """
+        Compare an item list with the last one imported for the station.
+        Returns the items to import, and whether they have to be merged
+        into the existing prices.
+        """
+        tdenv = self.tdenv
+        oldItems = markets.get(str(stationID), {}).get('td')
+        if oldItems is None:
+            tdenv.NOTE("New market, {} items.", len(itemList))
+            return itemList, False
+
+        newItems = {itemTD[0]: itemTD for itemTD in itemList}
+        changed = [
+            itemTD for itemTD in itemList
+            if oldItems.get(itemTD[0]) != list(itemTD)
+        ]
+        # an explicit 0/0 entry removes the item when merging
+        removed = [
+            (itmName, 0, 0, "-", "-")
+            for itmName in sorted(oldItems.keys() - newItems.keys())
+        ]
+        tdenv.NOTE(
+            "Market: {} changed, {} removed items.",
+            len(changed), len(removed)
+        )
+        return changed + removed, True
+
+    def importFile(self, sysName, stnName, itemList, mergeImport):
+        """
+        Import the items through a .prices file
+        """
+        tdb, tdenv = self.tdb, self.tdenv
+
+        # Create the import file.
+        with open(self.filename, 'w', encoding="utf-8") as f:
+            # write System/Station line
+            f.write("@ {}/{}\n".format(sysName, stnName))
+
+            # write Item lines (category lines are not needed)
+            for itemTD in itemList:
+                f.write("\t\t%s %s %s %s %s\n" % itemTD)
+
+        tdenv.ignoreUnknown = True
+        if mergeImport:
+            tdenv.mergeImport = True
+        cache.importDataFromFile(
+            tdb,
+            tdenv,
+            pathlib.Path(self.filename),
+        )
+
+    def touchMarket(self, station):
+        """
+        Refresh the modified time of all the station's items after a merge
+        import through a .prices file
+        """
+        tdb, tdenv = self.tdb, self.tdenv
+        modified = datetime.now(timezone.utc).strftime('%Y-%m-%d %H:%M:%S')
+        db = tdb.getDB()
+        db.execute(
+            """
+            UPDATE StationItem SET modified = ?
+             WHERE station_id = ?
+            """,
+            [modified, station.ID]
+        )
+        db.commit()
+        cache.regeneratePricesFile(tdb, tdenv)
+
+    def importDirect(self, station, itemList, mergeImport):
+        """
+        Write the items straight into StationItem in one transaction, then
+        regenerate TradeDangerous.prices from the database. A merge import
+        is the diff of a full market, so it also refreshes the modified
+        time of the station's unchanged items.
+        """
+        tdb, tdenv = self.tdb, self.tdenv
+
+        def tdQuantity(value):
+            # "123M" -> (123, 2), "?" -> (-1, -1), "-" -> (0, 0)
+            if value == "?":
+                return -1, -1
+            if value == "-":
+                return 0, 0
+            return int(value[:-1]), tdLevels[value[-1]]
+        tdLevels = {'?': -1, 'L': 1, 'M': 2, 'H': 3}
+
+        db = tdb.getDB()
+        itemIDs = {
+            name.upper(): itemID for itemID, name in db.execute(
+                "SELECT item_id, name FROM Item"
+            )
+        }
+
+        modified = datetime.now(timezone.utc).strftime('%Y-%m-%d %H:%M:%S')
+        addRows, delRows = [], []
+        for itmName, itmSellPrice, itmBuyPrice, tdDemand, tdSupply in itemList:
+            itemID = itemIDs.get(itmName.upper())
+            if itemID is None:
+                tdenv.NOTE("Ignoring unknown item '{}'.", itmName)
+                continue
+            if mergeImport and itmSellPrice == 0 and itmBuyPrice == 0:
+                # an explicit 0/0 entry removes the item when merging
+                delRows.append((station.ID, itemID))
+                continue
+            demandUnits, demandLevel = tdQuantity(tdDemand)
+            supplyUnits, supplyLevel = tdQuantity(tdSupply)
+            addRows.append((
+                station.ID, itemID,
+                itmSellPrice, demandUnits, demandLevel,
+                itmBuyPrice, supplyUnits, supplyLevel,
+                modified,
+            ))
+
+        try:
+            if not mergeImport:
+                db.execute(
+                    "DELETE FROM StationItem WHERE station_id = ?",
+                    [station.ID]
+                )
+            db.executemany(
+                """
+                DELETE FROM StationItem
+                 WHERE station_id = ?
+                   AND item_id = ?
+                """,
+                delRows
+            )
+            db.executemany(
+                """
+                INSERT OR REPLACE INTO StationItem (
+                    station_id, item_id,
+                    demand_price, demand_units, demand_level,
+                    supply_price, supply_units, supply_level,
+                    modified
+                ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+                """,
+                addRows
+            )
+            if mergeImport:
+                db.execute(
+                    """
+                    UPDATE StationItem SET modified = ?
+                     WHERE station_id = ?
+                    """,
+                    [modified, station.ID]
+                )
+            db.commit()
+        except sqlite3.Error:
+            db.rollback()
+            raise
+        tdenv.NOTE(
+            "Imported {} and removed {} items for '{}'.",
+            len(addRows), len(delRows), station.name()
+        )
+
+        # TD rebuilds the database from the .prices file whenever a source
+        # file is newer, so the file has to carry these prices too.
+        cache.regeneratePricesFile(tdb, tdenv)
+
+    def fetchProfile(self):
+        """
+        Get the commander profile from the API or the test file
+        """
+        tdenv = self.tdenv
 
         # Connect to the API, authenticate, and pull down the commander
         # /profile.
@@ -714,7 +1330,32 @@ class ImportPlugin(plugins.ImportPluginBase):
                 login=self.getOption('login'),
                 debug=tdenv.debug,
             )
+        return api
+
+    def syncEDCD(self):
+        """
+        Update the database with the EDCD plugin
+        """
+        tdb, tdenv = self.tdb, self.tdenv
+        try:
+            import plugins.edcd_plug as EDCD
+        except:
+            raise plugins.PluginException("EDCD plugin not found.")
+        tdenv.NOTE("Calling the EDCD plugin.")
+        edcdPlugin = EDCD.ImportPlugin(tdb, tdenv)
+        edcdPlugin.options["csvs"] = True
+        edcdPlugin.run()
+        tdenv.NOTE("Going back to EDAPI.\n")
+
+    def run(self):
+        tdb, tdenv = self.tdb, self.tdenv
+        timer = StageTimer(tdenv)
+
+        # Get the profile first, nothing else is needed if the commander
+        # is not docked.
+        api = self.fetchProfile()
         self.edAPI = api
+        timer.lap("fetch")
 
         # save profile if requested
         if self.getOption("save"):
@@ -738,31 +1379,43 @@ class ImportPlugin(plugins.ImportPluginBase):
         stnName = api.profile['lastStarport']['name']
         print('@{}/{}'.format(sysName.upper(), stnName))
 
+        # Only update from EDCD now that there is something to import.
+        if self.getOption("edcd"):
+            self.syncEDCD()
+            timer.lap("edcd")
+
         # Reload the cache.
         tdenv.DEBUG0("Checking the cache")
         tdb.close()
         tdb.reloadCache()
-        tdb.load(
-            maxSystemLinkLy=tdenv.maxSystemLinkLy,
-        )
-        tdb.close()
-
-        # Check to see if this system is in the database
-        try:
-            system = tdb.lookupSystem(sysName)
-        except LookupError:
-            raise plugins.PluginException(
-                "System '{}' unknown.".format(sysName)
+        self.stamp = self.dbStamp()
+        timer.lap("cache")
+
+        # Check to see if this system and station are in the database
+        startTime = time.time()
+        sysID, station = self.lookupLocation(sysName, stnName)
+        tdenv.DEBUG0("Location found in {:.3f}s", time.time() - startTime)
+
+        # New or update station data. TD needs its System and Station
+        # objects for that, so it only loads when there is something to
+        # save.
+        newStation = self.askForStationData(station=station)
+        if station is None or any(
+            getattr(station, key) != value for key, value in newStation.items()
+        ):
+            startTime = time.time()
+            tdb.load(
+                maxSystemLinkLy=tdenv.maxSystemLinkLy,
             )
-
-        # Check to see if this station is in the database
-        try:
-            station = tdb.lookupStation(stnName, system)
-        except LookupError:
-            station = None
-
-        # New or update station data
-        station = self.askForStationData(system, stnName=stnName, station=station)
+            tdb.close()
+            tdenv.DEBUG0("TD loaded in {:.3f}s", time.time() - startTime)
+            station = self.saveStationData(
+                tdb.systemByID[sysID],
+                stnName,
+                station and tdb.stationByID[station.ID],
+                newStation,
+            )
+        timer.lap("station")
 
         # If a shipyard exists, make the ship lists
         shipCost = {}
@@ -771,6 +1424,7 @@ class ImportPlugin(plugins.ImportPluginBase):
         if ((station.shipyard == "Y") and
             ('ships' in api.profile['lastStarport'])
         ):
+            shipMap = self.fdevMap('ships')
             if 'shipyard_list' in api.profile['lastStarport']['ships']:
                 if len(api.profile['lastStarport']['ships']['shipyard_list']):
                     for ship in api.profile['lastStarport']['ships']['shipyard_list'].values():
@@ -787,65 +1441,74 @@ class ImportPlugin(plugins.ImportPluginBase):
                     eddn_ships.append(ship['name'])
 
         if self.getOption("csvs"):
-            addRows = delRows = 0
+            startTime = time.time()
             db = tdb.getDB()
+            oldShips = set(
+                shipID for (shipID,) in db.execute(
+                    """
+                    SELECT ship_id FROM ShipVendor
+                     WHERE station_id = ?
+                    """,
+                    [station.ID]
+                )
+            )
             if station.shipyard == "N":
                 # delete all ships if there is no shipyard
-                delRows = db.execute(
+                newShips = set()
+            elif len(shipList):
+                # the shipyard has exactly the ships of the API response
+                newShips = set()
+                for shipID, shipName, costTD in db.execute(
+                    "SELECT ship_id, name, cost FROM Ship"
+                ):
+                    if shipName not in shipCost:
+                        continue
+                    newShips.add(shipID)
+                    # check for ship discount, costTD = 100%
+                    # python builtin round() uses "Round half to even"
+                    # but we need commercial rounding, so we do it ourself
+                    costED = int((shipCost[shipName]+5)/10)*10
+                    if costTD != costED:
+                        prozED = int(shipCost[shipName]*100/costTD+0.5)-100
+                        tdenv.NOTE(
+                            "CostDiff {}: {} != {} ({}%)",
+                            shipName, costTD, costED, prozED
+                        )
+            else:
+                newShips = oldShips
+
+            addShips = sorted(newShips - oldShips)
+            delShips = sorted(oldShips - newShips)
+            if addShips or delShips:
+                tdenv.DEBUG0(
+                    "ShipVendor station {}: add {}, delete {}",
+                    station.ID, addShips, delShips
+                )
+                db.executemany(
+                    """
+                    INSERT OR IGNORE INTO ShipVendor(station_id, ship_id)
+                    VALUES(?, ?)
+                    """,
+                    [(station.ID, shipID) for shipID in addShips]
+                )
+                db.executemany(
                     """
                     DELETE FROM ShipVendor
                      WHERE station_id = ?
+                       AND ship_id = ?
                     """,
-                    [station.ID]
-                ).rowcount
-
-            if len(shipList):
-                # and now update the shipyard list
-                # we go through all ships to decide if a ship needs to be
-                # added or deleted from the shipyard
-                for shipID in tdb.shipByID:
-                    shipName = tdb.shipByID[shipID].dbname
-                    if shipName in shipList:
-                        # check for ship discount, costTD = 100%
-                        # python builtin round() uses "Round half to even"
-                        # but we need commercial rounding, so we do it ourself
-                        costTD = tdb.shipByID[shipID].cost
-                        costED = int((shipCost[shipName]+5)/10)*10
-                        if costTD != costED:
-                            prozED = int(shipCost[shipName]*100/costTD+0.5)-100
-                            tdenv.NOTE(
-                                "CostDiff {}: {} != {} ({}%)",
-                                shipName, costTD, costED, prozED
-                            )
-                        # add the ship to the shipyard
-                        shipSQL = (
-                            "INSERT OR IGNORE"
-                             " INTO ShipVendor(station_id, ship_id)"
-                           " VALUES(?, ?)"
-                        )
-                        tdenv.DEBUG0(shipSQL.replace("?", "{}"), station.ID, shipID)
-                        addRows += db.execute(shipSQL, [station.ID, shipID]).rowcount
-                    else:
-                        # delete the ship from the shipyard
-                        shipSQL = (
-                            "DELETE FROM ShipVendor"
-                            " WHERE station_id = ?"
-                              " AND ship_id = ?"
-                        )
-                        tdenv.DEBUG0(shipSQL.replace("?", "{}"), station.ID, shipID)
-                        delRows += db.execute(shipSQL, [station.ID, shipID]).rowcount
-
-            db.commit()
-            if (addRows + delRows) > 0:
-                if addRows > 0:
+                    [(station.ID, shipID) for shipID in delShips]
+                )
+                db.commit()
+                if addShips:
                     tdenv.NOTE(
                         "Added {} ships in '{}' shipyard.",
-                        addRows, station.name()
+                        len(addShips), station.name()
                     )
-                if delRows > 0:
+                if delShips:
                     tdenv.NOTE(
                         "Deleted {} ships in '{}' shipyard.",
-                        delRows, station.name()
+                        len(delShips), station.name()
                     )
                 lines, csvPath = csvexport.exportTableToFile(
                     tdb,
@@ -853,6 +1516,10 @@ class ImportPlugin(plugins.ImportPluginBase):
                     "ShipVendor",
                 )
                 tdenv.DEBUG0("{} updated.", csvPath)
+            tdenv.DEBUG0(
+                "ShipVendor reconciled in {:.3f}s", time.time() - startTime
+            )
+        timer.lap("shipyard")
 
         # If a market exists, make the item lists
         itemList = []
@@ -860,6 +1527,7 @@ class ImportPlugin(plugins.ImportPluginBase):
         if ((station.market == "Y") and
             ('commodities' in api.profile['lastStarport'])
         ):
+            itemMap = self.fdevMap('items')
             for commodity in api.profile['lastStarport']['commodities']:
                 if commodity['categoryname'] in cat_ignore:
                     continue
@@ -930,30 +1598,43 @@ class ImportPlugin(plugins.ImportPluginBase):
                         itemEDDN["statusFlags"] = commodity['statusFlags']
                     eddn_market.append(itemEDDN)
 
-        if itemList:
-            # Create the import file.
-            with open(self.filename, 'w', encoding="utf-8") as f:
-                # write System/Station line
-                f.write("@ {}/{}\n".format(sysName, stnName))
-
-                # write Item lines (category lines are not needed)
-                for itemTD in itemList:
-                    f.write("\t\t%s %s %s %s %s\n" % itemTD)
-
-            tdenv.ignoreUnknown = True
-            cache.importDataFromFile(
-                tdb,
-                tdenv,
-                pathlib.Path(self.filename),
-            )
-
-        # Import EDDN
+        timer.lap("market")
+
+        # Only import the items that changed since the last import.
+        markets = None
+        mergeImport = False
+        fullItemList = itemList
+        if self.getOption("diff") and itemList:
+            stationID = str(api.profile['lastStarport']['id'])
+            markets = self.loadMarkets()
+            itemList, mergeImport = self.diffMarket(markets, stationID, itemList)
+            # The TD item list leaves out too much to tell whether the
+            # market posted to EDDN changed, so compare that on its own.
+            eddnDigest = self.marketDigest(eddn_market)
+            if markets.get(stationID, {}).get('eddn') == eddnDigest:
+                tdenv.NOTE("Market unchanged since the last EDDN post.")
+                eddn_market = []
+
+        # Post to EDDN in the background while the prices are imported.
+        con = None
         if self.getOption("eddn"):
+            window = self.getOption("window")
+            try:
+                window = 3600 if window is None else int(window)
+            except ValueError:
+                raise plugins.PluginException(
+                    "Option 'window' must be a number of seconds"
+                )
+            state = None
+            if window > 0:
+                state = PublishState(str(self.eddnStatePath), window=window)
             con = EDDN(
                 api.profile['commander']['name'],
                 self.getOption("name"),
                 'EDAPI Trade Dangerous Plugin',
-                __version__
+                __version__,
+                state=state,
+                workers=3
             )
             if self.getOption("test"):
                 con._debug = True
@@ -1001,5 +1682,58 @@ class ImportPlugin(plugins.ImportPluginBase):
                         sorted(eddn_modules)
                     )
 
+        timer.lap("eddn")
+
+        # A merge import still runs without changed items, to mark the
+        # unchanged prices as seen now.
+        if itemList or mergeImport:
+            startTime = time.time()
+            if self.getOption("file"):
+                direct = False
+            else:
+                try:
+                    self.importDirect(station, itemList, mergeImport)
+                    direct = True
+                except sqlite3.Error as e:
+                    tdenv.WARN("Direct import failed ({}), using a .prices file.", e)
+                    direct = False
+            if not direct:
+                if itemList:
+                    self.importFile(sysName, stnName, itemList, mergeImport)
+                if mergeImport:
+                    self.touchMarket(station)
+            tdenv.DEBUG0(
+                "Imported {} items in {:.3f}s", len(itemList), time.time() - startTime
+            )
+
+        # The database is what we loaded plus our own changes, so the next
+        # run can reuse the mapping tables.
+        stamp = self.dbStamp()
+        if self.fdevMaps is not None:
+            self.saveStamped(self.fdevPath, self.fdevMaps, stamp)
+        timer.lap("import")
+
+        posted = True
+        if con is not None:
+            posted = con.flush(timeout=120)
+            timer.lap("flush")
+
+        # Remember the market, but keep the last posted EDDN market if this
+        # post failed, so the next run tries again.
+        if markets is not None:
+            if not posted:
+                eddnDigest = markets.get(stationID, {}).get('eddn')
+            markets[stationID] = {
+                'td': {itemTD[0]: list(itemTD) for itemTD in fullItemList},
+                'eddn': eddnDigest,
+            }
+            self.saveMarkets(markets)
+
+        if not posted:
+            raise plugins.PluginException(
+                "Not all messages were posted to the EDDN."
+            )
+        timer.total()
+
         # We did all the work
         return False
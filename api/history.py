@@ -0,0 +1,151 @@
+"""
+Local price history of every market we have seen.
+
+"""
+
+import sqlite3
+import time
+
+
+class PriceHistory:
+    '''
+    An append-only SQLite store of commodity prices, indexed by commodity
+    and by station over time.
+    '''
+
+    _fields = (
+        'buyPrice',
+        'sellPrice',
+        'meanPrice',
+        'stock',
+        'stockBracket',
+        'demand',
+        'demandBracket',
+    )
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.db = sqlite3.connect(filename)
+        self.db.row_factory = sqlite3.Row
+        self.db.execute("PRAGMA journal_mode = WAL")
+        with self.db:
+            self.db.execute(
+                """
+                CREATE TABLE IF NOT EXISTS price (
+                    station_id INTEGER NOT NULL,
+                    system TEXT NOT NULL,
+                    station TEXT NOT NULL,
+                    commodity TEXT NOT NULL,
+                    timestamp REAL NOT NULL,
+                    buyPrice INTEGER,
+                    sellPrice INTEGER,
+                    meanPrice INTEGER,
+                    stock INTEGER,
+                    stockBracket INTEGER,
+                    demand INTEGER,
+                    demandBracket INTEGER
+                )
+                """
+            )
+            self.db.execute(
+                """
+                CREATE INDEX IF NOT EXISTS idx_price_commodity
+                    ON price (commodity, timestamp)
+                """
+            )
+            self.db.execute(
+                """
+                CREATE INDEX IF NOT EXISTS idx_price_station
+                    ON price (station_id, timestamp)
+                """
+            )
+
+    def record(self, stationID, system, station, commodities, timestamp=None):
+        '''
+        Append a market, given as EDDN commodity entries.
+        '''
+        if timestamp is None:
+            timestamp = time.time()
+
+        def bracket(value):
+            return value if value != '' else None
+
+        with self.db:
+            self.db.executemany(
+                """
+                INSERT INTO price VALUES (
+                    ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?
+                )
+                """,
+                (
+                    (
+                        stationID, system, station,
+                        commodity['name'], timestamp,
+                        commodity['buyPrice'],
+                        commodity['sellPrice'],
+                        commodity['meanPrice'],
+                        commodity['stock'],
+                        bracket(commodity['stockBracket']),
+                        commodity['demand'],
+                        bracket(commodity['demandBracket']),
+                    )
+                    for commodity in commodities
+                )
+            )
+
+    def latest(self, commodity):
+        '''
+        The most recent price of a commodity at every station.
+        '''
+        # SQLite takes the bare columns from the row holding the MAX().
+        return self.db.execute(
+            """
+            SELECT *, MAX(timestamp) AS timestamp
+              FROM price
+             WHERE commodity = ?
+             GROUP BY station_id
+             ORDER BY system, station
+            """,
+            [commodity]
+        ).fetchall()
+
+    def history(self, commodity, stationID=None, since=0):
+        '''
+        The prices of a commodity over time, optionally at one station.
+        '''
+        if stationID is None:
+            return self.db.execute(
+                """
+                SELECT * FROM price
+                 WHERE commodity = ? AND timestamp >= ?
+                 ORDER BY timestamp
+                """,
+                [commodity, since]
+            ).fetchall()
+        return self.db.execute(
+            """
+            SELECT * FROM price
+             WHERE station_id = ? AND timestamp >= ? AND commodity = ?
+             ORDER BY timestamp
+            """,
+            [stationID, since, commodity]
+        ).fetchall()
+
+    def best(self, commodity, limit=5):
+        '''
+        The stations with the lowest buy and the highest sell price for a
+        commodity, going by their latest prices.
+        '''
+        rows = self.latest(commodity)
+        buy = sorted(
+            (row for row in rows if row['buyPrice'] > 0 and row['stock'] > 0),
+            key=lambda row: row['buyPrice']
+        )
+        sell = sorted(
+            (row for row in rows if row['sellPrice'] > 0),
+            key=lambda row: -row['sellPrice']
+        )
+        return buy[:limit], sell[:limit]
+
+    def close(self):
+        self.db.close()
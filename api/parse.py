@@ -1,9 +1,23 @@
+from collections import namedtuple
+
 from utils.const import cat_ignore
 
+# Wraps a bare profile dict for the get_* functions below.
+Profile = namedtuple('Profile', ['profile'])
+
+
 def commodity_int(number):
+    # The API mostly sends ints already, skip the conversion for those.
+    if type(number) is int:
+        return number
+    if number == '':
+        return 0
     try:
-        ret = int(float(number)+0.5)
-    except (ValueError, KeyError):
+        if type(number) is float:
+            ret = int(number+0.5)
+        else:
+            ret = int(float(number)+0.5)
+    except (ValueError, KeyError, TypeError, OverflowError):
         ret = 0
     return ret
 
@@ -16,31 +30,38 @@ def economy_number(number):
     return ret
 
 
+def eddn_commodities(commodities):
+    '''
+    Yield the EDDN entries for an iterable of API commodities.
+    '''
+    for commodity in commodities:
+        # Ignore any special categories.
+        if commodity['categoryname'] in cat_ignore:
+            continue
+
+        # Ignore any illegal commodities per schema.
+        if commodity.get('legality', '') != '':
+            continue
+
+        itemEDDN = {
+            "name":          commodity['name'],
+            "meanPrice":     commodity_int(commodity['meanPrice']),
+            "buyPrice":      commodity_int(commodity['buyPrice']),
+            "stock":         commodity_int(commodity['stock']),
+            "stockBracket":  commodity['stockBracket'],
+            "sellPrice":     commodity_int(commodity['sellPrice']),
+            "demand":        commodity_int(commodity['demand']),
+            "demandBracket": commodity['demandBracket'],
+        }
+        if len(commodity['statusFlags']) > 0:
+            itemEDDN["statusFlags"] = commodity['statusFlags']
+        yield itemEDDN
+
+
 def get_commodities(api):
     commodities = []
     if 'commodities' in api.profile['lastStarport']:
-        for commodity in api.profile['lastStarport']['commodities']:
-            # Ignore any special categories.
-            if commodity['categoryname'] in cat_ignore:
-                continue
-
-            # Ignore any illegal commodities per schema.
-            if commodity.get('legality', '') != '':
-                continue
-
-            itemEDDN = {
-                "name":          commodity['name'],
-                "meanPrice":     commodity_int(commodity['meanPrice']),
-                "buyPrice":      commodity_int(commodity['buyPrice']),
-                "stock":         commodity_int(commodity['stock']),
-                "stockBracket":  commodity['stockBracket'],
-                "sellPrice":     commodity_int(commodity['sellPrice']),
-                "demand":        commodity_int(commodity['demand']),
-                "demandBracket": commodity['demandBracket'],
-            }
-            if len(commodity['statusFlags']) > 0:
-                itemEDDN["statusFlags"] = commodity['statusFlags']
-            commodities.append(itemEDDN)
+        commodities = list(eddn_commodities(api.profile['lastStarport']['commodities']))  # NOQA
     return commodities
 
 
@@ -55,39 +76,88 @@ def get_economies(api):
             economies.append(itemEDDN)
     return economies
 
+def iter_ships(api):
+    '''
+    Yield the names of the ships sold or listed as unavailable.
+    '''
+    ships = api.profile['lastStarport'].get('ships')
+    if not ships:
+        return
+
+    # Ships that can be purchased.
+    if ships.get('shipyard_list'):
+        for ship in ships['shipyard_list'].values():
+            yield ship['name']
+
+    # Ships that are restricted.
+    for ship in ships.get('unavailable_list', ()):
+        yield ship['name']
+
+
 def get_ships(api):
-    ships = []
-    if 'ships' in api.profile['lastStarport']:
-        # Ships that can be purchased.
-        if 'shipyard_list' in api.profile['lastStarport']['ships']:
-            if len(api.profile['lastStarport']['ships']['shipyard_list']):
-                for ship in api.profile['lastStarport']['ships']['shipyard_list'].values():  # NOQA
-                    # Add to EDDN.
-                    ships.append(ship['name'])
-
-        # Ships that are restricted.
-        if 'unavailable_list' in api.profile['lastStarport']['ships']:
-            for ship in api.profile['lastStarport']['ships']['unavailable_list']:  # NOQA
-                # Add to EDDN.
-                ships.append(ship['name'])
-    return sorted(ships)
+    return sorted(iter_ships(api))
+
+
+def iter_modules(api):
+    '''
+    Yield the names of the modules that are published.
+    '''
+    # For EDDN, only add non-commander specific items that can be
+    # purchased.
+    # https://github.com/EDSM-NET/EDDN/wiki
+    for module in api.profile['lastStarport'].get('modules', {}).values():
+        if (
+            module.get('sku', None) in (
+                None,
+                'ELITE_HORIZONS_V_PLANETARY_LANDINGS'
+            ) and
+            (
+                module['name'].startswith(('Hpt_', 'Int_')) or
+                module['name'].find('_Armour_') > 0
+            )
+        ):
+            yield module['name']
+
 
 def get_modules(api):
-    modules = []
-    if 'modules' in api.profile['lastStarport']:
-        # For EDDN, only add non-commander specific items that can be
-        # purchased.
-        # https://github.com/EDSM-NET/EDDN/wiki
-        for module in api.profile['lastStarport']['modules'].values():
-            if (
-                module.get('sku', None) in (
-                    None,
-                    'ELITE_HORIZONS_V_PLANETARY_LANDINGS'
-                ) and
-                (
-                    module['name'].startswith(('Hpt_', 'Int_')) or
-                    module['name'].find('_Armour_') > 0
-                )
-            ):
-                modules.append(module['name'])
-    return sorted(modules)
+    return sorted(iter_modules(api))
+
+
+def benchmark(rows=100000):
+    '''
+    Time the commodity extractors on a large synthetic market.
+    '''
+    import random
+    import time
+
+    commodities = [
+        {
+            'name': 'Commodity{}'.format(i),
+            'categoryname': 'Metals',
+            'meanPrice': random.randint(100, 10000),
+            'buyPrice': random.randint(0, 10000),
+            'stock': float(random.randint(0, 50000)),
+            'stockBracket': random.randint(0, 3),
+            'sellPrice': random.randint(100, 10000),
+            'demand': random.random() * 50000,
+            'demandBracket': '',
+            'statusFlags': [],
+        }
+        for i in range(rows)
+    ]
+
+    for name, func in (
+        ('get_commodities', lambda: get_commodities(Profile({'lastStarport': {'commodities': commodities}}))),  # NOQA
+        ('eddn_commodities', lambda: sum(1 for c in eddn_commodities(commodities))),  # NOQA
+    ):
+        best = None
+        for attempt in range(3):
+            start = time.time()
+            func()
+            elapsed = time.time() - start
+            best = elapsed if best is None else min(best, elapsed)
+        print('{:>16}: {} rows in {:.3f}s'.format(name, rows, best))
+
+
+if __name__ == '__main__':
+    benchmark()
@@ -0,0 +1,162 @@
+"""
+Incremental reading of large API responses and saved dumps.
+
+Only the array we are after is decoded, one item at a time, so the rest
+of the response never becomes a dict tree in memory.
+"""
+
+import json
+import re
+import sys
+import time
+import tracemalloc
+
+import api.parse as parse
+
+
+_decoder = json.JSONDecoder()
+_whitespace = re.compile(r'[\s,]*')
+
+# Characters of lookahead after a decoded number, string or literal.
+_scalarTail = 32
+
+
+def iter_array(file, key, chunksize=65536):
+    '''
+    Yield the items of the first array stored under key in a JSON text
+    file, decoding them one at a time.
+    '''
+    return _iter_array(file, key, chunksize, None)
+
+
+def load(file, key, convert, chunksize=65536):
+    '''
+    Decode a JSON text file, except for the first array stored under key.
+    Its items are streamed through convert(), which must consume all of
+    them. Returns the document, with that array left empty, and what
+    convert() returned.
+    '''
+    outside = []
+    converted = convert(_iter_array(file, key, chunksize, outside))
+    outside.append(file.read())
+    return json.loads(''.join(outside)), converted
+
+
+def _iter_array(file, key, chunksize, outside):
+    # The text around the array is appended to outside, unless it is None.
+    start = re.compile(r'"' + re.escape(key) + r'"\s*:\s*\[')
+
+    # Find the start of the array. Keep enough of the previous chunk to
+    # match a key split across two reads.
+    keep = len(key) + 64
+    buf = ''
+    while True:
+        match = start.search(buf)
+        if match:
+            if outside is not None:
+                outside.append(buf[:match.end()])
+            buf = buf[match.end():]
+            break
+        chunk = file.read(chunksize)
+        if not chunk:
+            if outside is not None:
+                outside.append(buf)
+            return
+        if outside is not None:
+            outside.append(buf[:-keep])
+        buf = buf[-keep:] + chunk
+
+    # Decode the items.
+    pos = 0
+    eof = False
+    while True:
+        pos = _whitespace.match(buf, pos).end()
+        if pos < len(buf) and buf[pos] == ']':
+            if outside is not None:
+                outside.append(buf[pos:])
+            return
+        try:
+            if pos >= len(buf):
+                raise ValueError('Need more data')
+            item, end = _decoder.raw_decode(buf, pos)
+        except ValueError:
+            # The item is cut off at the end of the buffer, read more.
+            if eof:
+                raise
+            chunk = file.read(chunksize)
+            if not chunk:
+                eof = True
+            buf = buf[pos:] + chunk
+            pos = 0
+            continue
+        # A number cut at a '.' or an 'e' still decodes, as its first
+        # part. Make sure a scalar is followed by enough text to end it.
+        if (
+            not eof and
+            not isinstance(item, (dict, list)) and
+            len(buf) - end < _scalarTail
+        ):
+            chunk = file.read(chunksize)
+            if chunk:
+                buf = buf[pos:] + chunk
+                pos = 0
+                continue
+            eof = True
+        yield item
+        pos = end
+
+
+def iter_commodities(file, chunksize=65536):
+    '''
+    Yield the EDDN entries for the first commodities array in a /market
+    response or saved dump.
+    '''
+    return parse.eddn_commodities(
+        iter_array(file, 'commodities', chunksize)
+    )
+
+
+def _measure(func):
+    tracemalloc.start()
+    start = time.time()
+    count = func()
+    elapsed = time.time() - start
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return count, elapsed, peak
+
+
+def benchmark(filename):
+    '''
+    Compare streaming the commodities of a file with loading it whole.
+    '''
+    def load():
+        with open(filename, encoding='utf-8') as file:
+            data = json.load(file)
+        if isinstance(data, list):
+            data = [item for item in data if 'commodities' in item][0]
+        else:
+            data = data['lastStarport']
+        return len(list(parse.eddn_commodities(data['commodities'])))
+
+    def stream():
+        with open(filename, encoding='utf-8') as file:
+            return sum(1 for item in iter_commodities(file))
+
+    for name, func in (('json.load', load), ('stream', stream)):
+        count, elapsed, peak = _measure(func)
+        print('{:>10}: {} commodities in {:.3f}s, peak {:.1f} MB'.format(
+            name,
+            count,
+            elapsed,
+            peak / 1e6
+        ))
+
+
+if __name__ == '__main__':
+    '''
+    Command line invocation: benchmark the given files.
+    '''
+    for filename in sys.argv[1:]:
+        print(filename)
+        benchmark(filename)
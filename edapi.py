@@ -3,12 +3,21 @@
 # Elite: Dangerous API Tool
 # ----------------------------------------------------------------
 
+import hashlib
+import itertools
 from pprint import pprint
 import json
+import requests
+import signal
 import sys
+import threading
+import time
 import traceback
 
+from api.bulk import BulkImport, EDDNSink, HistorySink, JSONLSink
 import api.companion as companion
+from api.diff import MarketCache
+from api.history import PriceHistory
 import api.parse as parse
 import eddn.eddn as eddn
 
@@ -26,11 +35,25 @@ def Main(args):
     '''
     Main function.
     '''
+    # User specified --replay-outbox. Post what is left and exit.
+    if args.replay_outbox:
+        return Replay(args)
+
+    # User specified --query. Look up the price history and exit.
+    if args.query:
+        return Query(args)
+
+    # User specified --bulk. Process saved API responses and exit.
+    if args.bulk:
+        return Bulk(args)
+
     # Connect to the API and grab all the info!
     api = companion.EDAPI(
+        basename=args.basename,
         debug=args.debug,
         json_file=args.json_file,
-        login=args.login
+        login=args.login,
+        concurrent=not args.sequential
     )
 
     # User specified --export. Print JSON and exit.
@@ -75,12 +98,195 @@ def Main(args):
         # Exit without doing anything else.
         sys.exit()
 
+    # User specified --daemon. Keep polling with the same session.
+    if args.daemon:
+        return Daemon(api, args, c)
+
     # Sanity check that we are docked
     if not api.profile['commander']['docked']:
         print(c.WARNING+'Commander not docked.'+c.ENDC)
         print(c.FAIL+'Aborting!'+c.ENDC)
         sys.exit(1)
 
+    # Open a connection to EDDN.
+    con = None
+    if args.eddn:
+        con = Connect(api.profile['commander']['name'], args)
+
+    posted = True
+    try:
+        Process(api, args, c, con)
+    finally:
+        if con is not None:
+            posted = Disconnect(con, args)
+
+    if not posted:
+        return 'Not all messages were posted to the EDDN.'
+
+    # No errors.
+    return False
+
+
+def Connect(commander, args, offline=False):
+    '''
+    Open a connection to the EDDN. If offline, messages are only journaled
+    in the outbox.
+    '''
+    # Remember what we posted, to skip identical messages.
+    state = None
+    if args.eddn_window > 0:
+        state = eddn.PublishState(
+            args.basename + '.eddn',
+            window=args.eddn_window
+        )
+
+    con = eddn.EDDN(
+        commander,
+        not args.hash,
+        'EDAPI',
+        __version__,
+        state=state,
+        workers=args.eddn_workers,
+        outbox=eddn.Outbox(args.basename + '.outbox'),
+        compress=args.eddn_compress or None,
+        offline=offline
+    )
+    con._debug = args.debug
+    return con
+
+
+def Disconnect(con, args):
+    '''
+    Close the connection to the EDDN.
+    '''
+    # Wait for any background posts.
+    ok = con.flush(timeout=120)
+    if args.debug:
+        print('EDDN stats:', con.stats)
+    con.close()
+    return ok
+
+
+def Bulk(args):
+    '''
+    Parse a directory or glob of saved API responses in parallel and
+    stream the stations to a sink.
+    '''
+    bulk = BulkImport(args.bulk, jobs=args.jobs)
+    print('{} files to process.'.format(len(bulk.files)))
+
+    results = iter(bulk)
+    first = next(results, None)
+    if first is None:
+        bulk.report()
+        return False
+    results = itertools.chain([first], results)
+
+    con = None
+    if args.bulk_sink == 'jsonl':
+        sink = JSONLSink(args.bulk_output)
+    elif args.bulk_sink == 'history':
+        if not args.history:
+            sys.exit('--bulk-sink history needs --history.')
+        sink = HistorySink(args.history)
+    else:
+        con = Connect(
+            first['commander'],
+            args,
+            offline=(args.bulk_sink == 'outbox')
+        )
+        sink = EDDNSink(con)
+
+    posted = True
+    try:
+        sink.write(results)
+        sink.close()
+    finally:
+        if con is not None:
+            posted = Disconnect(con, args)
+
+    bulk.report()
+
+    if not posted or (con is not None and sink.failed):
+        return 'Not all messages were posted to the EDDN.'
+
+    # No errors.
+    return False
+
+
+def Query(args):
+    '''
+    Print the latest prices, price history or best prices of a commodity.
+    '''
+    if not args.history or not args.commodity:
+        sys.exit('--query needs --history and --commodity.')
+
+    def printRows(rows):
+        for row in rows:
+            print('{} | {:>30} | {:>30} | {:>7,d} | {:>7,d} | {:>9,d} | {:>9,d}'.format(  # NOQA
+                time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(row['timestamp'])),  # NOQA
+                row['system'],
+                row['station'],
+                row['buyPrice'],
+                row['sellPrice'],
+                row['stock'],
+                row['demand'],
+            ))
+
+    history = PriceHistory(args.history)
+    try:
+        start = time.time()
+        if args.query == 'latest':
+            printRows(history.latest(args.commodity))
+        elif args.query == 'history':
+            printRows(history.history(args.commodity))
+        else:
+            buy, sell = history.best(args.commodity)
+            print('Best places to buy:')
+            printRows(buy)
+            print('Best places to sell:')
+            printRows(sell)
+        if args.debug:
+            print('Query took {:.3f}s'.format(time.time() - start))
+    finally:
+        history.close()
+
+    # No errors.
+    return False
+
+
+def Replay(args):
+    '''
+    Post the messages left in the EDDN outbox by earlier runs.
+    '''
+    # The messages already carry their header, so no uploader is needed.
+    con = eddn.EDDN(
+        '',
+        True,
+        'EDAPI',
+        __version__,
+        outbox=eddn.Outbox(args.basename + '.outbox'),
+        compress=args.eddn_compress or None
+    )
+    con._debug = args.debug
+    try:
+        print('{} messages in the outbox.'.format(con.outbox.count()))
+        con.replayOutbox(rate=args.replay_rate)
+        left = con.outbox.count()
+    finally:
+        Disconnect(con, args)
+
+    if left:
+        return '{} messages are still in the outbox.'.format(left)
+
+    # No errors.
+    return False
+
+
+def Process(api, args, c, con):
+    '''
+    Parse the docked station and optionally publish it to the EDDN.
+    '''
     print_profile(api, c)
 
     system = api.profile['lastSystem']['name']
@@ -108,6 +314,29 @@ def Main(args):
     # Process the commodities market.
     commodities = parse.get_commodities(api)
 
+    # Keep the prices in the local history.
+    if args.history and commodities:
+        history = PriceHistory(args.history)
+        try:
+            history.record(
+                api.profile['lastStarport']['id'],
+                system,
+                station,
+                commodities
+            )
+        finally:
+            history.close()
+
+    # Compare the market with the last one seen for this station.
+    market = None
+    if args.changed_only:
+        market = MarketCache(args.basename + '.markets')
+        stationID = api.profile['lastStarport']['id']
+        delta = market.diff(stationID, commodities)
+        print('Market:', delta)
+        if not delta:
+            commodities = []
+
     # Process the station economies.
     economies = parse.get_economies(api)
 
@@ -121,16 +350,7 @@ def Main(args):
     modules = parse.get_modules(api)
 
     # Publish to EDDN
-    if args.eddn:
-        # Open a connection.
-        con = eddn.EDDN(
-            api.profile['commander']['name'],
-            not args.hash,
-            'EDAPI',
-            __version__
-        )
-        con._debug = args.debug
-
+    if con is not None:
         if commodities:
             print('Posting commodities to EDDN...')
             con.publishCommodities(system, station, commodities, economies, prohibited)
@@ -143,6 +363,94 @@ def Main(args):
             print('Posting outfitting to EDDN...')
             con.publishOutfitting(system, station, modules)
 
+    # Only remember the market once its post went through, so a failed
+    # one is posted again next time.
+    if market is not None and commodities:
+        if con is None or con.flush(timeout=120):
+            market.update(stationID, commodities)
+
+
+def StationState(api):
+    '''
+    Identify the docked station and the state of its market, shipyard and
+    outfitting. Returns None if not docked.
+    '''
+    if not api.profile['commander']['docked']:
+        return None
+    return hashlib.sha1(
+        json.dumps(
+            [api.profile['lastSystem'], api.profile['lastStarport']],
+            sort_keys=True
+        ).encode('utf8')
+    ).hexdigest()
+
+
+def Daemon(api, args, c):
+    '''
+    Poll the API every args.interval seconds, and process the station only
+    when we docked somewhere else or the station data changed.
+    '''
+    stop = threading.Event()
+
+    def stopHandler(signum, frame):
+        print(c.WARNING+'Stopping...'+c.ENDC)
+        stop.set()
+
+    signal.signal(signal.SIGINT, stopHandler)
+    signal.signal(signal.SIGTERM, stopHandler)
+
+    con = None
+    lastState = None
+    polled = True
+    try:
+        while not stop.is_set():
+            # After a failed poll the profile may be stale or incomplete,
+            # so wait for the next good one.
+            if polled:
+                state = StationState(api)
+                if state is None:
+                    if lastState is not None:
+                        print(c.WARNING+'Commander not docked.'+c.ENDC)
+                elif state != lastState:
+                    try:
+                        if args.eddn and con is None:
+                            con = Connect(api.profile['commander']['name'], args)  # NOQA
+                        Process(api, args, c, con)
+                        if con is not None and con.flush():
+                            # The gateway is up, catch up on earlier
+                            # failures.
+                            if con.outbox.count():
+                                con.replayOutbox(rate=args.replay_rate)
+                    except Exception as e:
+                        print(c.FAIL+'Unable to process the station: '+repr(e)+c.ENDC)  # NOQA
+                        if args.debug:
+                            traceback.print_exc()
+                        # Try the station again on the next poll.
+                        state = lastState
+                elif args.debug:
+                    print('Nothing changed.')
+                lastState = state
+
+            # Wait for the next poll, or until we are told to stop.
+            if stop.wait(args.interval):
+                break
+
+            try:
+                api.refresh()
+                polled = True
+            except (
+                requests.exceptions.RequestException,
+                companion.APIError,
+                ValueError,
+                KeyError
+            ) as e:
+                print(c.FAIL+'Unable to poll the API: '+repr(e)+c.ENDC)
+                polled = False
+    finally:
+        if con is not None:
+            Disconnect(con, args)
+        api.close()
+
     # No errors.
     return False
 
@@ -168,6 +476,9 @@ if __name__ == "__main__":
     except SystemExit as e:
         # Clean exit, provide a return code.
         sys.exit(e.code)
+    except companion.APIError as e:
+        # The API refused us, no traceback needed.
+        sys.exit(str(e))
     except:
         # Handle all other exceptions.
         ErrStr = traceback.format_exc()
@@ -4,11 +4,221 @@ Python Implementation of the EDDN publisher:
 https://github.com/EDSM-NET/EDDN/blob/master/examples/PHP/EDDN.php
 """
 
+from concurrent.futures import Future, ThreadPoolExecutor, wait
 from datetime import datetime, timezone
+import gzip
 import hashlib
 import json
+import os
 import random
 import requests
+import sqlite3
+import tempfile
+import threading
+import time
+
+
+class PublishState:
+    '''
+    Remembers a hash of the last message published for each system,
+    station and schema, so identical messages can be skipped for a while.
+    '''
+
+    def __init__(
+        self,
+        filename,
+        window=3600
+    ):
+        self.filename = filename
+        self.window = window
+        self.entries = {}
+
+        if os.path.exists(self.filename):
+            try:
+                with open(self.filename) as h:
+                    self.entries = json.load(h)
+            except ValueError:
+                print('Unable to read EDDN state file.')
+
+        # Entries older than the window can never match again.
+        now = time.time()
+        self.entries = {
+            key: entry for key, entry in self.entries.items()
+            if now - entry[1] < self.window
+        }
+        self.dirty = False
+
+    @staticmethod
+    def key(message):
+        return '|'.join((
+            message['message']['systemName'],
+            message['message']['stationName'],
+            message['$schemaRef'],
+        ))
+
+    @staticmethod
+    def digest(message):
+        # The timestamp changes every time, so leave it out.
+        payload = dict(message['message'])
+        payload.pop('timestamp', None)
+        return hashlib.sha1(
+            json.dumps(
+                payload,
+                sort_keys=True,
+                separators=(',', ':')
+            ).encode('utf8')
+        ).hexdigest()
+
+    def isDuplicate(self, message):
+        '''
+        True if the same message was published within the window.
+        '''
+        entry = self.entries.get(self.key(message))
+        if entry is None:
+            return False
+        digest, published = entry
+        return (
+            digest == self.digest(message) and
+            time.time() - published < self.window
+        )
+
+    def record(self, message):
+        '''
+        Remember a published message. The state file is only written by
+        save().
+        '''
+        self.entries[self.key(message)] = [self.digest(message), time.time()]
+        self.dirty = True
+
+    def save(self):
+        '''
+        Write the state file, if anything was recorded since the last save.
+        '''
+        if not self.dirty:
+            return
+        statedir = os.path.dirname(os.path.abspath(self.filename))
+        fd, tmpname = tempfile.mkstemp(dir=statedir, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'w') as h:
+                json.dump(self.entries, h)
+            os.replace(tmpname, self.filename)
+        except:
+            os.unlink(tmpname)
+            raise
+        self.dirty = False
+
+
+class Outbox:
+    '''
+    A local SQLite journal of messages. Every message is written here
+    before it is posted and marked as sent once the gateway accepted it,
+    so nothing is lost when the gateway is down. A message the gateway
+    rejected is marked as failed with the error instead, and is not
+    posted again.
+    '''
+
+    # Sent and failed messages are kept this many seconds before they are
+    # purged.
+    _keep = 86400
+
+    def __init__(
+        self,
+        filename
+    ):
+        self.filename = filename
+        self._lock = threading.Lock()
+        self.db = sqlite3.connect(filename, check_same_thread=False)
+        with self.db:
+            self.db.execute(
+                """
+                CREATE TABLE IF NOT EXISTS outbox (
+                    id INTEGER PRIMARY KEY,
+                    created REAL NOT NULL,
+                    message TEXT NOT NULL,
+                    sent REAL,
+                    failed REAL,
+                    error TEXT
+                )
+                """
+            )
+            columns = [
+                row[1] for row in self.db.execute("PRAGMA table_info(outbox)")
+            ]
+            if 'failed' not in columns:
+                self.db.execute("ALTER TABLE outbox ADD COLUMN failed REAL")
+                self.db.execute("ALTER TABLE outbox ADD COLUMN error TEXT")
+            self.db.execute(
+                """
+                CREATE INDEX IF NOT EXISTS idx_outbox_sent
+                    ON outbox (sent, id)
+                """
+            )
+            self.db.execute(
+                "DELETE FROM outbox WHERE sent < ? OR failed < ?",
+                [time.time() - self._keep] * 2
+            )
+
+    def add(self, data):
+        '''
+        Journal an encoded message. Returns its id.
+        '''
+        with self._lock, self.db:
+            return self.db.execute(
+                "INSERT INTO outbox (created, message) VALUES (?, ?)",
+                [time.time(), data.decode('utf8')]
+            ).lastrowid
+
+    def ack(self, messageID):
+        '''
+        Mark a message as accepted by the gateway.
+        '''
+        with self._lock, self.db:
+            self.db.execute(
+                "UPDATE outbox SET sent = ? WHERE id = ?",
+                [time.time(), messageID]
+            )
+
+    def reject(self, messageID, error):
+        '''
+        Mark a message as rejected by the gateway, so it is not posted
+        again.
+        '''
+        with self._lock, self.db:
+            self.db.execute(
+                "UPDATE outbox SET failed = ?, error = ? WHERE id = ?",
+                [time.time(), error, messageID]
+            )
+
+    def pending(self, limit):
+        '''
+        The oldest messages that were neither sent nor rejected yet, as
+        (id, data) pairs.
+        '''
+        with self._lock:
+            rows = self.db.execute(
+                """
+                SELECT id, message FROM outbox
+                 WHERE sent IS NULL
+                   AND failed IS NULL
+                 ORDER BY id
+                 LIMIT ?
+                """,
+                [limit]
+            ).fetchall()
+        return [(messageID, message.encode('utf8')) for messageID, message in rows]  # NOQA
+
+    def count(self):
+        with self._lock:
+            return self.db.execute(
+                """
+                SELECT COUNT(*) FROM outbox
+                 WHERE sent IS NULL
+                   AND failed IS NULL
+                """
+            ).fetchone()[0]
+
+    def close(self):
+        self.db.close()
 
 
 class EDDN:
@@ -34,6 +244,13 @@ class EDDN:
 
     _debug = True
 
+    # Retry policy for connection errors and these HTTP status codes. The
+    # delay doubles after every retry.
+    _retries = 3
+    _backoff = 1.0
+    _timeout = 30
+    _retryStatus = (429, 500, 502, 503, 504)
+
     # As of 1.3, ED reports four levels.
     _levels = (
         'Low',
@@ -47,7 +264,12 @@ class EDDN:
         uploaderID,
         noHash,
         softwareName,
-        softwareVersion
+        softwareVersion,
+        state=None,
+        workers=0,
+        outbox=None,
+        compress=1024,
+        offline=False
     ):
         # Obfuscate uploaderID
         if noHash:
@@ -56,25 +278,182 @@ class EDDN:
             self.uploaderID = hashlib.sha1(uploaderID.encode('utf-8')).hexdigest()
         self.softwareName = softwareName
         self.softwareVersion = softwareVersion
+        self.state = state
+        self.outbox = outbox
+
+        # Only journal messages in the outbox, replayOutbox() posts them.
+        self.offline = offline
+
+        # Gzip message bodies of at least this many bytes. None disables.
+        self.compress = compress
+
+        # One pooled session, so connections to the gateway are kept alive
+        # between messages.
+        self.session = requests.Session()
+
+        self.stats = {
+            'messages': 0,
+            'attempts': 0,
+            'retries': 0,
+            'failures': 0,
+            'latency': 0.0,
+            'bytes': 0,
+            'bytesSent': 0,
+            'compressTime': 0.0,
+        }
+        self._lock = threading.Lock()
+
+        # With workers, messages are posted in the background and
+        # postMessage() returns a future instead of waiting.
+        self._executor = None
+        self._futures = []
+        if workers > 0:
+            self._executor = ThreadPoolExecutor(max_workers=workers)
+
+    def close(self):
+        '''
+        Stop the background posts, save the publish state and close the
+        outbox and the HTTP session. Posts that have not started yet are
+        cancelled and stay in the outbox, running ones are waited for.
+        '''
+        if self._executor is not None:
+            for future in self._futures:
+                future.cancel()
+            self._futures = []
+            self._executor.shutdown(wait=True)
+        self.saveState()
+        if self.outbox is not None:
+            self.outbox.close()
+        self.session.close()
+
+    def flush(self, timeout=None):
+        '''
+        Wait for background posts to finish and save the publish state.
+        Returns False if any of them failed or did not finish within the
+        timeout.
+        '''
+        ok = not self._drain(timeout)
+        self.saveState()
+        return ok
+
+    def saveState(self):
+        '''
+        Write the publish state file, if anything was published.
+        '''
+        if self.state is not None:
+            with self._lock:
+                self.state.save()
+
+    def _drain(self, timeout=None):
+        '''
+        Wait for background posts to finish. Returns the number of them
+        that failed or did not finish within the timeout. Those that did
+        not finish are kept, so close() can still cancel them.
+        '''
+        futures, self._futures = self._futures, []
+        if not futures:
+            return 0
+
+        done, pending = wait(futures, timeout=timeout)
+        failed = len(pending)
+        for future in done:
+            error = future.exception()
+            if error is not None:
+                print('EDDN post failed:', error)
+                failed += 1
+        if pending:
+            print('{} EDDN posts still pending.'.format(len(pending)))
+            self._futures.extend(pending)
+        return failed
+
+    def _count(self, key, value=1):
+        with self._lock:
+            self.stats[key] += value
+
+    def _post(self, url, headers, data):
+        '''
+        POST data to the gateways, retrying with backoff on connection
+        errors and retryable status codes. Each retry picks another gateway
+        if there is one.
+        '''
+        for attempt in range(self._retries + 1):
+            self._count('attempts')
+            error = None
+            response = None
+            start = time.time()
+            try:
+                response = self.session.post(
+                    url,
+                    headers=headers,
+                    data=data,
+                    verify=True,
+                    timeout=self._timeout
+                )
+            except (
+                requests.exceptions.ConnectionError,
+                requests.exceptions.Timeout
+            ) as e:
+                error = e
+            self._count('latency', time.time() - start)
+
+            if response is not None and response.status_code not in self._retryStatus:  # NOQA
+                break
+            if attempt == self._retries:
+                break
+
+            self._count('retries')
+            delay = self._backoff * 2 ** attempt
+            print('EDDN post failed ({}), retrying in {:.0f}s...'.format(
+                error if response is None else response.status_code,
+                delay
+            ))
+            time.sleep(delay)
+
+            others = [gateway for gateway in self._gateways if gateway != url]
+            if others:
+                url = random.choice(others)
+
+        if response is None:
+            self._count('failures')
+            raise error
+
+        try:
+            response.raise_for_status()
+        except requests.exceptions.HTTPError:
+            self._count('failures')
+            raise
+
+        self._count('messages')
+        return response
+
+    def _rejected(self, error):
+        '''
+        True if the gateway refused the message itself, so posting it again
+        can not succeed.
+        '''
+        response = getattr(error, 'response', None)
+        return (
+            response is not None and
+            400 <= response.status_code < 500 and
+            response.status_code not in self._retryStatus
+        )
 
     def postMessage(
         self,
         message,
         timestamp=0
     ):
+        if self.state is not None and self.state.isDuplicate(message):
+            print('Unchanged since the last post, skipped.')
+            return False
+
         if timestamp:
-            timestamp = datetime.fromtimestamp(timestamp).isoformat()
+            timestamp = datetime.fromtimestamp(timestamp, timezone.utc).isoformat()
         else:
             timestamp = datetime.now(timezone.utc).astimezone().isoformat()
 
         message['message']['timestamp'] = timestamp
 
-        url = random.choice(self._gateways)
-
-        headers = {
-            'content-type': 'application/json; charset=utf8'
-        }
-
         if self._debug:
             print(
                 json.dumps(
@@ -84,17 +463,93 @@ class EDDN:
                 )
             )
 
-        r = requests.post(
-            url,
-            headers=headers,
-            data=json.dumps(
-                message,
-                ensure_ascii=False
-            ).encode('utf8'),
-            verify=True
-        )
+        data = json.dumps(
+            message,
+            ensure_ascii=False
+        ).encode('utf8')
+
+        # Journal the message first, so it survives a failed post.
+        messageID = None
+        if self.outbox is not None:
+            messageID = self.outbox.add(data)
 
-        r.raise_for_status()
+        if self.offline:
+            return messageID is not None
+
+        if self._executor is not None:
+            future = self._executor.submit(
+                self._send, data, message, messageID
+            )
+            self._futures.append(future)
+            return future
+
+        return self._send(data, message, messageID)
+
+    def _send(self, data, message=None, messageID=None):
+        headers = {
+            'content-type': 'application/json; charset=utf8'
+        }
+
+        size = len(data)
+        if self.compress is not None and size >= self.compress:
+            start = time.time()
+            data = gzip.compress(data)
+            self._count('compressTime', time.time() - start)
+            headers['content-encoding'] = 'gzip'
+
+        self._count('bytes', size)
+        self._count('bytesSent', len(data))
+
+        try:
+            self._post(random.choice(self._gateways), headers, data)
+        except requests.exceptions.HTTPError as e:
+            if messageID is not None and self._rejected(e):
+                self.outbox.reject(messageID, str(e))
+            raise
+
+        if messageID is not None:
+            self.outbox.ack(messageID)
+
+        if self.state is not None and message is not None:
+            with self._lock:
+                self.state.record(message)
+
+        return True
+
+    def replayOutbox(
+        self,
+        batch=50,
+        rate=2.0
+    ):
+        '''
+        Post the messages left in the outbox, oldest first, at most rate
+        messages per second. A message the gateway rejects is marked as
+        failed and skipped. Stops at the first connection error, timeout
+        or retryable status. Returns the number of messages sent.
+        '''
+        sent = 0
+        while True:
+            messages = self.outbox.pending(batch)
+            if not messages:
+                break
+            for messageID, data in messages:
+                start = time.time()
+                try:
+                    self._send(data, messageID=messageID)
+                    sent += 1
+                except requests.exceptions.RequestException as e:
+                    if not self._rejected(e):
+                        print('EDDN replay stopped:', e)
+                        return sent
+                    print('EDDN rejected message {}: {}'.format(messageID, e))
+                delay = 1.0 / rate - (time.time() - start)
+                if delay > 0:
+                    time.sleep(delay)
+            print('Replayed {} messages, {} left.'.format(
+                sent,
+                self.outbox.count()
+            ))
+        return sent
 
     def publishCommodities(
         self,
@@ -123,7 +578,7 @@ class EDDN:
             'prohibited': prohibited,
         }
 
-        self.postMessage(message, timestamp)
+        return self.postMessage(message, timestamp)
 
     def publishShipyard(
         self,
@@ -148,7 +603,7 @@ class EDDN:
             'ships': ships,
         }
 
-        self.postMessage(message, timestamp)
+        return self.postMessage(message, timestamp)
 
     def publishOutfitting(
         self,
@@ -173,6 +628,72 @@ class EDDN:
             'modules': modules,
         }
 
-        self.postMessage(message, timestamp)
-
+        return self.postMessage(message, timestamp)
 
+    def publishBatch(
+        self,
+        stations,
+        batch=100,
+        timestamp=0
+    ):
+        '''
+        Publish many stations over the pooled connection. stations is an
+        iterable of (systemName, stationName, payload), where payload is a
+        dict that may hold 'commodities' (with 'economies' and
+        'prohibited'), 'ships', 'modules' and its own 'timestamp'. The
+        gateway only takes one message per request, so background posts
+        are flushed every batch messages to bound the number in flight.
+        Returns the number of messages posted, the number that failed and
+        the elapsed seconds. Skipped duplicates count as neither.
+        '''
+        start = time.time()
+        posted = 0
+        failed = 0
+        queued = 0
+        for systemName, stationName, payload in stations:
+            stamp = payload.get('timestamp', timestamp)
+            messages = []
+            if payload.get('commodities'):
+                messages.append((self.publishCommodities, (
+                    payload['commodities'],
+                    payload.get('economies', []),
+                    payload.get('prohibited', []),
+                )))
+            if payload.get('ships'):
+                messages.append((self.publishShipyard, (payload['ships'],)))
+            if payload.get('modules'):
+                messages.append((self.publishOutfitting, (payload['modules'],)))  # NOQA
+
+            for publish, args in messages:
+                try:
+                    result = publish(systemName, stationName, *args, stamp)
+                except requests.exceptions.RequestException as e:
+                    print('EDDN post failed:', e)
+                    failed += 1
+                    continue
+                if result is False:
+                    continue
+                if isinstance(result, Future):
+                    queued += 1
+                else:
+                    posted += 1
+
+            if queued >= batch:
+                errors = self._drain()
+                posted += queued - errors
+                failed += errors
+                queued = 0
+
+        errors = self._drain()
+        posted += queued - errors
+        failed += errors
+        self.saveState()
+
+        elapsed = time.time() - start
+        print('Published {} messages, {} failed, in {:.1f}s ({:.1f} messages/s).'.format(  # NOQA
+            posted,
+            failed,
+            elapsed,
+            posted / elapsed if elapsed else 0.0
+        ))
+        return posted, failed, elapsed
@@ -5,14 +5,22 @@
 # ----------------------------------------------------------------
 
 import argparse
-import datetime
+import collections
+import gzip
+import multiprocessing
+import queue
+import re
+import signal
 import simplejson
 import sys
+import threading
 import time
 import traceback
 import zlib
 import zmq
 
+from eddn_sinks import ConsoleSink, JSONLSink, SQLiteSink
+
 __version_info__ = ('3', '6', '0')
 __version__ = '.'.join(__version_info__)
 
@@ -52,7 +60,119 @@ def parse_args():
     parser.add_argument("--timeout",
                         default=600000,
                         type=int,
-                        help='Connection timeout.')
+                        help='Longest wait for a message before reconnecting,\
+                        in milliseconds.')
+
+    # Stall detection
+    parser.add_argument("--stall-factor",
+                        default=20,
+                        type=int,
+                        help='Reconnect after STALL_FACTOR times the usual gap\
+                        between messages without one...')
+    parser.add_argument("--stall-min",
+                        default=30,
+                        type=int,
+                        help='...but not before STALL_MIN seconds.')
+
+    # Reconnect backoff
+    parser.add_argument("--backoff-max",
+                        default=60,
+                        type=int,
+                        help='Longest wait between reconnects, in seconds. The\
+                        wait doubles from 1 second while reconnects fail.')
+
+    # Keepalive
+    parser.add_argument("--keepalive",
+                        default=60,
+                        type=int,
+                        help='Idle seconds before TCP keepalive probes are\
+                        sent. 0 disables them.')
+    parser.add_argument("--heartbeat",
+                        default=30,
+                        type=int,
+                        help='Seconds between ZMQ heartbeats, if the zmq\
+                        library has them. 0 disables them.')
+
+    # Decoder workers
+    parser.add_argument("--workers",
+                        default=2,
+                        type=int,
+                        help='Number of decoder processes. 0 decodes on the\
+                        main thread.')
+
+    # Queue size
+    parser.add_argument("--queue-size",
+                        default=10000,
+                        type=int,
+                        help='Number of received messages to hold while the\
+                        decoders catch up. Messages beyond are dropped.')
+
+    # Batch size
+    parser.add_argument("--batch",
+                        default=64,
+                        type=int,
+                        help='Maximum number of messages handed to a decoder\
+                        at once.')
+
+    # Statistics
+    parser.add_argument("--stats",
+                        default=60,
+                        type=int,
+                        help='Print the message counters every STATS seconds.\
+                        0 disables them.')
+
+    # Quiet
+    parser.add_argument("--quiet",
+                        action="store_true",
+                        default=False,
+                        help="Print one line per message.")
+
+    # Pre-filter
+    parser.add_argument("--no-prefilter",
+                        action="store_true",
+                        default=False,
+                        help="Decode every message, also the ones not white\
+                        listed, to see them on the console.")
+
+    # Benchmark
+    parser.add_argument("--benchmark",
+                        default=None,
+                        metavar="FILE",
+                        help="Measure the decoding speed with and without the\
+                        pre-filter on the messages of a jsonl sink file,\
+                        then exit.")
+
+    # Sinks
+    parser.add_argument("--sink",
+                        default=["console"],
+                        choices=["console", "jsonl", "sqlite"],
+                        nargs='+',
+                        help="Where the messages go. The jsonl and sqlite\
+                        sinks only get white listed messages.")
+
+    # JSONL archive
+    parser.add_argument("--archive",
+                        default=".",
+                        help='Directory of the jsonl sink files.')
+    parser.add_argument("--rotate",
+                        default=3600,
+                        type=int,
+                        help='Start a new jsonl sink file every ROTATE\
+                        seconds.')
+
+    # SQLite store
+    parser.add_argument("--database",
+                        default="eddn.sqlite",
+                        help='Database file of the sqlite sink.')
+    parser.add_argument("--sqlite-batch",
+                        default=500,
+                        type=int,
+                        help='Insert into the database every SQLITE_BATCH\
+                        messages...')
+    parser.add_argument("--sqlite-interval",
+                        default=1000,
+                        type=int,
+                        help='...or every SQLITE_INTERVAL milliseconds.')
 
     # Software
     parser.add_argument("--software",
@@ -70,33 +190,461 @@ def parse_args():
     return args
 
 
-def date(format):
+class Console:
     '''
-    Date format helper.
+    Buffered console output. The time stamp is formatted once per second,
+    and the buffer is written out when it is large or old enough.
     '''
-    d = datetime.datetime.utcnow()
-    return d.strftime(format)
+
+    def __init__(self, stream=sys.stdout, size=65536, interval=0.5):
+        self.stream = stream
+        self.size = size
+        self.interval = interval
+        self.lock = threading.Lock()
+        self.buffer = []
+        self.buffered = 0
+        self.lastFlush = time.time()
+        self.second = None
+
+    def write(self, lines):
+        '''
+        Write lines as one block. Only the first line of a new second gets
+        the time stamp.
+        '''
+        now = int(time.time())
+        with self.lock:
+            if now != self.second:
+                self.second = now
+                prefix = time.strftime('%H:%M:%S', time.gmtime(now)) + ' | '
+            else:
+                prefix = '        ' + ' | '
+            text = prefix + '\n         | '.join(lines) + '\n'
+            self.buffer.append(text)
+            self.buffered += len(text)
+            if (
+                self.buffered >= self.size or
+                time.time() - self.lastFlush >= self.interval
+            ):
+                self._flush()
+
+    def poll(self):
+        '''
+        Write out the buffer if it is old enough.
+        '''
+        if self.buffer and time.time() - self.lastFlush >= self.interval:
+            self.flush()
+
+    def flush(self):
+        with self.lock:
+            self._flush()
+
+    def _flush(self):
+        if self.buffer:
+            self.stream.write(''.join(self.buffer))
+            self.buffer = []
+            self.buffered = 0
+        self.stream.flush()
+        self.lastFlush = time.time()
+
+
+console = Console()
 
 
 def echoLog(line):
     '''
     Format console output.
     '''
-    if (echoLog.oldTime is False) or (echoLog.oldTime != date('%H:%M:%S')):
-        echoLog.oldTime = date('%H:%M:%S')
-        line = str(echoLog.oldTime) + ' | ' + str(line)
+    console.write([str(line)])
+
+
+class Receiver(threading.Thread):
+    '''
+    Receive raw messages from the relay and queue them for the decoders.
+    The socket is only used by this thread. A new socket is made when
+    the connection fails or the messages stop coming for much longer
+    than usual.
+    '''
+
+    def __init__(
+        self,
+        relay,
+        timeout,
+        frames,
+        stallFactor=20,
+        stallMin=30,
+        backoffMax=60,
+        keepalive=60,
+        heartbeat=30
+    ):
+        super().__init__(daemon=True)
+        self.relay = relay
+        self.timeout = timeout / 1000
+        self.frames = frames
+        self.stallFactor = stallFactor
+        self.stallMin = stallMin
+        self.backoffMax = backoffMax
+        self.keepalive = keepalive
+        self.heartbeat = heartbeat
+        self.context = zmq.Context()
+
+        self.received = 0
+        self.dropped = 0
+        self.reconnects = 0
+        self.downtime = 0.0
+        self.downSince = None
+        # Moving average of the time between two messages.
+        self.gap = None
+
+    def stallTimeout(self):
+        '''
+        How long to wait for a message before reconnecting.
+        '''
+        if self.gap is None:
+            return self.timeout
+        return min(max(self.stallFactor * self.gap, self.stallMin), self.timeout)  # NOQA
+
+    def disconnectedFor(self):
+        '''
+        Total time without messages since the stream was first lost.
+        '''
+        if self.downSince is None:
+            return self.downtime
+        return self.downtime + time.time() - self.downSince
+
+    def connect(self):
+        # Configure the zmq subscriber.
+        subscriber = self.context.socket(zmq.SUB)
+        subscriber.setsockopt(zmq.SUBSCRIBE, b"")
+        subscriber.setsockopt(zmq.LINGER, 0)
+        if self.keepalive > 0:
+            subscriber.setsockopt(zmq.TCP_KEEPALIVE, 1)
+            subscriber.setsockopt(zmq.TCP_KEEPALIVE_IDLE, self.keepalive)
+            subscriber.setsockopt(zmq.TCP_KEEPALIVE_INTVL, max(self.keepalive // 4, 1))  # NOQA
+            subscriber.setsockopt(zmq.TCP_KEEPALIVE_CNT, 4)
+        # Heartbeats need libzmq 4.2.
+        if self.heartbeat > 0 and hasattr(zmq, 'HEARTBEAT_IVL'):
+            subscriber.setsockopt(zmq.HEARTBEAT_IVL, self.heartbeat * 1000)
+            subscriber.setsockopt(zmq.HEARTBEAT_TIMEOUT, self.heartbeat * 3000)  # NOQA
+        subscriber.connect(self.relay)
+        return subscriber
+
+    def receive(self, subscriber):
+        '''
+        Queue messages until they stop coming. Returns whether any came.
+        '''
+        connected = time.time()
+        lastMessage = None
+        while True:
+            if not subscriber.poll(1000):
+                since = lastMessage or connected
+                if time.time() - since > self.stallTimeout():
+                    if lastMessage is not None:
+                        self.downSince = lastMessage
+                    return lastMessage is not None
+                continue
+
+            frame = subscriber.recv(zmq.NOBLOCK)
+            now = time.time()
+            if self.downSince is not None:
+                self.downtime += now - self.downSince
+                self.downSince = None
+            if lastMessage is not None:
+                gap = now - lastMessage
+                self.gap = gap if self.gap is None else 0.9 * self.gap + 0.1 * gap  # NOQA
+            lastMessage = now
+
+            # Never block the socket, drop if the decoders lag.
+            self.received += 1
+            try:
+                self.frames.put_nowait(frame)
+            except queue.Full:
+                self.dropped += 1
+
+    def run(self):
+        backoff = 1
+        first = True
+
+        # Do this forever.
+        while True:
+            subscriber = None
+            try:
+                # Connect.
+                if not first:
+                    self.reconnects += 1
+                first = False
+                subscriber = self.connect()
+                echoLog('Connected to ' + self.relay)
+                echoLog('')
+                echoLog('')
+
+                if self.receive(subscriber):
+                    backoff = 1
+                echoLog('No messages for {:.0f}s, reconnecting.'.format(
+                    self.stallTimeout()
+                ))
+
+            # Connect error... Retry...
+            except zmq.ZMQError as e:
+                echoLog('')
+                echoLog('ZMQSocketException: ' + str(e))
+                echoLog('')
+                if self.downSince is None:
+                    self.downSince = time.time()
+
+            finally:
+                if subscriber is not None:
+                    subscriber.close(0)
+
+            time.sleep(backoff)
+            backoff = min(backoff * 2, self.backoffMax)
+
+
+def initWorker():
+    '''
+    Leave Ctrl-C to the main process.
+    '''
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+
+schemaRefRE = re.compile(rb'"\$schemaRef"\s*:\s*"([^"\\]*)"')
+softwareNameRE = re.compile(rb'"softwareName"\s*:\s*"([^"\\]*)"')
+
+
+def prefilter(raw, wanted):
+    '''
+    Check the schema and software of a decompressed message before it is
+    decoded. wanted is (schemas, software), software None allows all.
+    Anything the expressions cannot read is left to the full check.
+    '''
+    schemas, software = wanted
+    match = schemaRefRE.search(raw)
+    if match and match.group(1).decode('utf-8', 'replace') not in schemas:
+        return False
+    if software is not None:
+        match = softwareNameRE.search(raw)
+        if match and match.group(1).decode('utf-8', 'replace') not in software:  # NOQA
+            return False
+    return True
+
+
+def decode(batch, wanted=None):
+    '''
+    Decompress and decode a batch of raw messages. Runs in a decoder
+    process, broken messages come back as None and the ones the
+    pre-filter drops as False.
+    '''
+    messages = []
+    for frame in batch:
+        try:
+            raw = zlib.decompress(frame)
+            if wanted is not None and not prefilter(raw, wanted):
+                messages.append(False)
+                continue
+            messages.append(simplejson.loads(raw))
+        except (zlib.error, ValueError):
+            messages.append(None)
+    return messages
+
+
+def takeBatch(frames, size, block):
+    '''
+    Take up to size queued messages. Waits up to a second for the first
+    one if block is set.
+    '''
+    try:
+        batch = [frames.get(block, 1)]
+    except queue.Empty:
+        return []
+    while len(batch) < size:
+        try:
+            batch.append(frames.get_nowait())
+        except queue.Empty:
+            break
+    return batch
+
+
+def isWanted(message, allowed_schemas):
+    '''
+    Check if the software and the schema are white listed.
+    '''
+    return (
+        (
+            message['header']['softwareName'] in args.software or
+            args.software == ['all']
+        ) and
+        message['$schemaRef'] in allowed_schemas
+    )
+
+
+def echoMessage(message, allowed_schemas):
+    '''
+    Print a decoded message as one block, or as one line in quiet mode.
+    '''
+    lines = []
+    echo = lines.append
+    # ID the schema.
+    schema = "Unknown"
+    if message['$schemaRef'] in allowed_schemas:
+        schema = allowed_schemas[message['$schemaRef']]
     else:
-        line = '        ' + ' | ' + str(line)
+        schema += ': ' + message['$schemaRef']
+    uploaderID = message['header']['uploaderID']
+    uploaderID = uploaderID[:16]+'...' if len(uploaderID) > 16 else uploaderID  # NOQA
+    echo(
+        'Received ' + schema +
+        ' ' + message['header']['softwareName'] +
+        ' / ' + message['header']['softwareVersion'] +
+        ' (' + uploaderID + ')'
+    )
 
-    print(line)
-    sys.stdout.flush()
-echoLog.oldTime = False
+    # Check if the software is white listed.
+    if not isWanted(message, allowed_schemas):
+        console.write(lines)
+        return
+
+    if args.quiet:
+        message = message['message']
+        lines[0] += ' {}/{}'.format(
+            message.get('systemName', '?'),
+            message.get('stationName', '?')
+        )
+        for key in ('commodities', 'ships', 'modules'):
+            if key in message:
+                lines[0] += ', {} {}'.format(len(message[key]), key)
+        console.write(lines)
+        return
+
+    # Log common info.
+    echo('\t- Schema: ' + message['$schemaRef'])
+    echo('\t- Software: ' + message['header']['softwareName'] + ' / ' + message['header']['softwareVersion'])  # NOQA
+    echo('\t- Timestamp: ' + message['message']['timestamp'])
+    echo('\t- Uploader ID: ' + message['header']['uploaderID'])
+    echo('\t\t- System Name: ' + message['message']['systemName'])  # NOQA
+    echo('\t\t- Station Name: ' + message['message']['stationName'])  # NOQA
+
+    # Handle commodity v3
+    if schema == 'commodity-v3':
+        echo('\t\t- Commodities:')
+        for com in message['message']['commodities']:
+            echo(
+                '\t\t\t- Name: ' +
+                com['name']
+            )
+            echo(
+                '\t\t\t\t- Buy Price: ' +
+                str(com['buyPrice'])
+            )
+            echo(
+                '\t\t\t\t- Stock: ' +
+                str(com['stock']) +
+                ' (' +
+                str(com.get('stockBracket', 'N/A')) +
+                ')'
+            )
+            echo(
+                '\t\t\t\t- Sell Price: ' +
+                str(com['sellPrice'])
+            )
+            echo(
+                '\t\t\t\t- Demand: ' +
+                str(com['demand']) +
+                ' (' +
+                str(com.get('demandBracket', 'N/A')) +
+                ')'
+            )
+        echo('\t\t- Economies:')
+        for econ in message['message']['economies']:
+            echo(
+                '\t\t\t- Name: ' +
+                econ['name']
+            )
+            echo(
+                '\t\t\t\t- Proportion: ' +
+                str(econ['proportion'])
+            )
+        echo('\t\t- Prohibited:')
+        for com in message['message']['prohibited']:
+            echo(
+                '\t\t\t- ' + com
+            )
+
+        echo('')
+        echo('')
+
+    # Handle shipyard v2
+    if schema == 'shipyard-v2':
+        for ship in message['message']['ships']:
+            echo('\t\t\t- Ship: ' + ship)
+
+        echo('')
+        echo('')
+
+    # Handle outfitting v2
+    if schema == 'outfitting-v2':
+        for module in message['message']['modules']:
+            echo('\t\t\t- Module: ' + module)
+
+        echo('')
+        echo('')
+
+    console.write(lines)
+
+
+def benchmark(filename):
+    '''
+    Decode the messages of a jsonl sink file with and without the
+    pre-filter, at different shares of wanted messages.
+    '''
+    opener = gzip.open if filename.endswith('.gz') else open
+    with opener(filename, 'rt', encoding='utf-8') as file:
+        messages = [simplejson.loads(line) for line in file if line.strip()]
+    if not messages:
+        print('No messages in ' + filename)
+        return 1
+    while len(messages) < 5000:
+        messages += messages
+    schemas = frozenset(message['$schemaRef'] for message in messages)
+    wanted = (schemas, frozenset(['Benchmark']))
+
+    print('{} messages, {:.1f} MB decompressed'.format(
+        len(messages),
+        sum(len(simplejson.dumps(message)) for message in messages) / 1e6
+    ))
+    for selectivity in (1.0, 0.5, 0.1, 0.01):
+        # Mark the share of wanted messages by their software name.
+        frames = []
+        for i, message in enumerate(messages):
+            keep = int((i + 1) * selectivity) > int(i * selectivity)
+            header = dict(message['header'])
+            header['softwareName'] = 'Benchmark' if keep else 'Filtered'
+            frames.append(zlib.compress(simplejson.dumps(
+                dict(message, header=header)
+            ).encode('utf-8')))
+
+        rates = []
+        for prefiltered in (False, True):
+            start = time.time()
+            if prefiltered:
+                decode(frames, wanted)
+            else:
+                # decode everything, then check the header
+                for message in decode(frames):
+                    message['header']['softwareName'] in wanted[1]
+            rates.append(len(frames) / (time.time() - start))
+        print('{:>5.0%} wanted: {:>8.0f} msg/s decoded, {:>8.0f} msg/s pre-filtered'.format(  # NOQA
+            selectivity,
+            rates[0],
+            rates[1],
+        ))
 
 
 def Main():
     '''
     Main()
     '''
+    if args.benchmark:
+        return benchmark(args.benchmark)
+
     # These are the schemas we will decode.
     allowed_schemas = {
         'https://eddn.edcd.io/schemas/commodity/3':           'commodity-v3',
@@ -127,142 +675,140 @@ def Main():
         echoLog('\t' + schema)
     echoLog('')
 
-    # Configure the zmq subscriber.
-    context = zmq.Context()
-    subscriber = context.socket(zmq.SUB)
-    subscriber.setsockopt(zmq.SUBSCRIBE, b"")
-    subscriber.setsockopt(zmq.RCVTIMEO, args.timeout)
+    # Every sink has a thread and a queue of its own.
+    consoleSink = None
+    dataSinks = []
+    if 'console' in args.sink:
+        consoleSink = ConsoleSink(
+            lambda message: echoMessage(message, allowed_schemas),
+            log=echoLog
+        )
+    if 'jsonl' in args.sink:
+        dataSinks.append(JSONLSink(
+            args.archive,
+            rotate=args.rotate,
+            log=echoLog
+        ))
+    if 'sqlite' in args.sink:
+        dataSinks.append(SQLiteSink(
+            args.database,
+            batch=args.sqlite_batch,
+            interval=args.sqlite_interval / 1000,
+            log=echoLog
+        ))
+    sinks = [sink for sink in [consoleSink] + dataSinks if sink is not None]
+    try:
+        for sink in sinks:
+            try:
+                sink.start()
+            except Exception as e:
+                sys.exit('{} could not start: {}'.format(
+                    type(sink).__name__,
+                    e
+                ))
+
+        Receive(allowed_schemas, consoleSink, dataSinks)
+    finally:
+        for sink in sinks:
+            sink.close(10)
+        console.flush()
+
+
+def Receive(allowed_schemas, consoleSink, dataSinks):
+    '''
+    Receive, decode and hand the messages to the sinks.
+    '''
+    sinks = [sink for sink in [consoleSink] + dataSinks if sink is not None]
+
+    # Drop what is not white listed before decoding it.
+    wanted = None
+    if not args.no_prefilter:
+        wanted = (
+            frozenset(allowed_schemas),
+            None if args.software == ['all'] else frozenset(args.software),
+        )
+
+    # Receive on a thread of its own, so the socket is read at the relay's
+    # pace while the messages are decoded in parallel.
+    frames = queue.Queue(args.queue_size)
+    receiver = Receiver(
+        args.relay,
+        args.timeout,
+        frames,
+        stallFactor=args.stall_factor,
+        stallMin=args.stall_min,
+        backoffMax=args.backoff_max,
+        keepalive=args.keepalive,
+        heartbeat=args.heartbeat
+    )
+    receiver.start()
 
-    # Do this forever.
-    while True:
-        try:
-            # Connect.
-            subscriber.connect(args.relay)
-            echoLog('Connected to ' + args.relay)
-            echoLog('')
-            echoLog('')
+    pool = None
+    if args.workers > 0:
+        pool = multiprocessing.Pool(args.workers, initWorker)
 
-            # Keep reading until disconnected.
-            while True:
-                message = subscriber.recv()
+    # Keep a few batches in flight per worker, but no more, so that the
+    # backlog stays in the bounded queue where it can be measured.
+    pending = collections.deque()
+    inflight = max(args.workers, 1) * 2
+    decoded = 0
+    filtered = 0
+    errors = 0
+    lastStats = time.time()
 
-                # We were disconnected.
+    while True:
+        while len(pending) < inflight:
+            batch = takeBatch(frames, args.batch, not pending)
+            if not batch:
+                break
+            if pool is None:
+                pending.append(decode(batch, wanted))
+            else:
+                pending.append(pool.apply_async(decode, (batch, wanted)))
+
+        if pending:
+            batch = pending.popleft()
+            if pool is not None:
+                batch = batch.get()
+            for message in batch:
+                if message is None:
+                    errors += 1
+                    continue
                 if message is False:
-                    subscriber.disconnect(args.relay)
-                    echoLog('Disconnected from ' + args.relay)
-                    echoLog('')
-                    echoLog('')
-                    break
-
-                # Decode the JSON message.
-                message = simplejson.loads(zlib.decompress(message))
-
-                # ID the schema.
-                schema = "Unknown"
-                if message['$schemaRef'] in allowed_schemas:
-                    schema = allowed_schemas[message['$schemaRef']]
-                else:
-                    schema += ': ' + message['$schemaRef']
-                uploaderID = message['header']['uploaderID']
-                uploaderID = uploaderID[:16]+'...' if len(uploaderID) > 16 else uploaderID  # NOQA
-                echoLog(
-                    'Received ' + schema +
-                    ' ' + message['header']['softwareName'] +
-                    ' / ' + message['header']['softwareVersion'] +
-                    ' (' + uploaderID + ')'
-                )
-
-                # Check if the software is white listed.
-                if (
-                    (
-                        message['header']['softwareName'] in args.software or
-                        args.software == ['all']
-                    ) and
-                    not schema.startswith("Unknown")
-                ):
-                    pass
-                else:
+                    filtered += 1
                     continue
-
-                # Log common info.
-                echoLog('\t- Schema: ' + message['$schemaRef'])
-                echoLog('\t- Software: ' + message['header']['softwareName'] + ' / ' + message['header']['softwareVersion'])  # NOQA
-                echoLog('\t- Timestamp: ' + message['message']['timestamp'])
-                echoLog('\t- Uploader ID: ' + message['header']['uploaderID'])
-                echoLog('\t\t- System Name: ' + message['message']['systemName'])  # NOQA
-                echoLog('\t\t- Station Name: ' + message['message']['stationName'])  # NOQA
-
-                # Handle commodity v3
-                if schema == 'commodity-v3':
-                    echoLog('\t\t- Commodities:')
-                    for com in message['message']['commodities']:
-                        echoLog(
-                            '\t\t\t- Name: ' +
-                            com['name']
-                        )
-                        echoLog(
-                            '\t\t\t\t- Buy Price: ' +
-                            str(com['buyPrice'])
-                        )
-                        echoLog(
-                            '\t\t\t\t- Stock: ' +
-                            str(com['stock']) +
-                            ' (' +
-                            str(com.get('stockBracket', 'N/A')) +
-                            ')'
-                        )
-                        echoLog(
-                            '\t\t\t\t- Sell Price: ' +
-                            str(com['sellPrice'])
-                        )
-                        echoLog(
-                            '\t\t\t\t- Demand: ' +
-                            str(com['demand']) +
-                            ' (' +
-                            str(com.get('demandBracket', 'N/A')) +
-                            ')'
-                        )
-                    echoLog('\t\t- Economies:')
-                    for econ in message['message']['economies']:
-                        echoLog(
-                            '\t\t\t- Name: ' +
-                            econ['name']
-                        )
-                        echoLog(
-                            '\t\t\t\t- Proportion: ' +
-                            str(econ['proportion'])
-                        )
-                    echoLog('\t\t- Prohibited:')
-                    for com in message['message']['prohibited']:
-                        echoLog(
-                            '\t\t\t- ' + com
-                        )
-
-                    echoLog('')
-                    echoLog('')
-
-                # Handle shipyard v2
-                if schema == 'shipyard-v2':
-                    for ship in message['message']['ships']:
-                        echoLog('\t\t\t- Ship: ' + ship)
-
-                    echoLog('')
-                    echoLog('')
-
-                # Handle outfitting v2
-                if schema == 'outfitting-v2':
-                    for module in message['message']['modules']:
-                        echoLog('\t\t\t- Module: ' + module)
-
-                    echoLog('')
-                    echoLog('')
-
-        # Connect error... Retry...
-        except zmq.ZMQError as e:
-            echoLog('')
-            echoLog('ZMQSocketException: ' + str(e))
-            echoLog('')
-            time.sleep(10)
+                decoded += 1
+                if consoleSink is not None:
+                    consoleSink.put(message)
+                if dataSinks and isWanted(message, allowed_schemas):
+                    for sink in dataSinks:
+                        sink.put(message)
+
+        console.poll()
+
+        if args.stats > 0 and time.time() - lastStats >= args.stats:
+            lastStats = time.time()
+            echoLog(
+                'Received {}, decoded {}, filtered {}, errors {}, dropped {}, queue {}/{}, reconnects {}, down {:.0f}s'.format(  # NOQA
+                    receiver.received,
+                    decoded,
+                    filtered,
+                    errors,
+                    receiver.dropped,
+                    frames.qsize(),
+                    args.queue_size,
+                    receiver.reconnects,
+                    receiver.disconnectedFor(),
+                ) + ''.join(
+                    '; {} written {}, failed {}, dropped {}'.format(
+                        type(sink).__name__,
+                        sink.written,
+                        sink.failed,
+                        sink.dropped,
+                    )
+                    for sink in sinks
+                )
+            )
 
 
 if __name__ == '__main__':
@@ -282,6 +828,7 @@ if __name__ == '__main__':
         # Execute the Main() function and return results.
         sys.exit(Main())
     except KeyboardInterrupt as e:
+        console.flush()
         print("Disconnecting...")
         sys.exit(0)
     except SystemExit as e:
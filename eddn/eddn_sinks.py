@@ -0,0 +1,230 @@
+"""
+Sinks for the messages received by the EDDN client. Every sink consumes
+the decoded messages on a thread of its own, in batches.
+"""
+
+import gzip
+import os
+import queue
+import simplejson
+import sqlite3
+import threading
+import time
+
+
+class Sink(threading.Thread):
+    '''
+    Consume messages in batches of up to batch messages, or whatever
+    arrived within interval seconds. A sink that falls behind drops
+    messages instead of holding up the others. A batch that can not be
+    written is logged and counted as failed. start() raises if the sink
+    can not be set up.
+    '''
+
+    def __init__(self, batch=1, interval=0.5, queueSize=10000, log=print):
+        super().__init__(daemon=True)
+        self.batch = batch
+        self.interval = interval
+        self.queue = queue.Queue(queueSize)
+        self.log = log
+        self.ready = threading.Event()
+        self.error = None
+        self.written = 0
+        self.failed = 0
+        self.dropped = 0
+
+    def put(self, message):
+        try:
+            self.queue.put_nowait(message)
+        except queue.Full:
+            self.dropped += 1
+
+    def start(self):
+        '''
+        Start the thread and wait until it is set up.
+        '''
+        super().start()
+        self.ready.wait()
+        if self.error is not None:
+            raise self.error
+
+    def run(self):
+        # The setup belongs to the sink thread, start() reports its error.
+        try:
+            self.setup()
+        except Exception as e:
+            self.error = e
+            self.teardown()
+            return
+        finally:
+            self.ready.set()
+        try:
+            while True:
+                messages = []
+                closing = False
+                deadline = time.time() + self.interval
+                while len(messages) < self.batch:
+                    try:
+                        message = self.queue.get(
+                            timeout=max(deadline - time.time(), 0)
+                        )
+                    except queue.Empty:
+                        break
+                    if message is None:
+                        closing = True
+                        break
+                    messages.append(message)
+                if messages:
+                    try:
+                        self.write(messages)
+                        self.written += len(messages)
+                    except Exception as e:
+                        self.failed += len(messages)
+                        self.log('{} failed to write {} messages: {!r}'.format(
+                            type(self).__name__,
+                            len(messages),
+                            e
+                        ))
+                if closing:
+                    return
+        finally:
+            self.teardown()
+
+    def close(self, timeout=None):
+        '''
+        Write what is queued and stop the thread, waiting at most timeout
+        seconds.
+        '''
+        if not self.is_alive():
+            return
+        deadline = None if timeout is None else time.time() + timeout
+        try:
+            self.queue.put(None, timeout=timeout)
+        except queue.Full:
+            # The thread is stuck, it dies with the process.
+            return
+        self.join(None if deadline is None else max(deadline - time.time(), 0))  # NOQA
+
+    def setup(self):
+        pass
+
+    def write(self, messages):
+        raise NotImplementedError
+
+    def teardown(self):
+        pass
+
+
+class ConsoleSink(Sink):
+    '''
+    Hand each message to a print function.
+    '''
+
+    def __init__(self, show, batch=100, **kwargs):
+        super().__init__(batch=batch, **kwargs)
+        self.show = show
+
+    def write(self, messages):
+        for message in messages:
+            self.show(message)
+
+
+class JSONLSink(Sink):
+    '''
+    Archive the messages as gzip compressed JSON lines. A new file is
+    started every rotate seconds.
+    '''
+
+    def __init__(self, directory, rotate=3600, batch=1000, interval=1.0, **kwargs):  # NOQA
+        super().__init__(batch=batch, interval=interval, **kwargs)
+        self.directory = directory
+        self.rotate = rotate
+        self.file = None
+        self.opened = 0
+
+    def write(self, messages):
+        now = time.time()
+        if self.file is None or now - self.opened >= self.rotate:
+            self.teardown()
+            filename = os.path.join(
+                self.directory,
+                time.strftime('eddn.%Y%m%d_%H%M%S.jsonl.gz', time.gmtime(now))
+            )
+            self.file = gzip.open(filename, 'at', encoding='utf-8')
+            self.opened = now
+        self.file.write(''.join(
+            simplejson.dumps(message) + '\n' for message in messages
+        ))
+        self.file.flush()
+
+    def teardown(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+
+class SQLiteSink(Sink):
+    '''
+    Store the messages in a SQLite database, one executemany() per
+    batch.
+    '''
+
+    def __init__(self, filename, batch=500, interval=1.0, **kwargs):
+        super().__init__(batch=batch, interval=interval, **kwargs)
+        self.filename = filename
+        self.db = None
+
+    def setup(self):
+        # The connection belongs to the sink thread.
+        self.db = sqlite3.connect(self.filename)
+        self.db.execute("PRAGMA journal_mode = WAL")
+        with self.db:
+            self.db.execute(
+                """
+                CREATE TABLE IF NOT EXISTS message (
+                    received REAL NOT NULL,
+                    schemaRef TEXT NOT NULL,
+                    softwareName TEXT,
+                    softwareVersion TEXT,
+                    uploaderID TEXT,
+                    systemName TEXT,
+                    stationName TEXT,
+                    timestamp TEXT,
+                    message TEXT NOT NULL
+                )
+                """
+            )
+            self.db.execute(
+                """
+                CREATE INDEX IF NOT EXISTS idx_message_schema
+                    ON message (schemaRef, received)
+                """
+            )
+
+    def write(self, messages):
+        received = time.time()
+        with self.db:
+            self.db.executemany(
+                """
+                INSERT INTO message VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+                """,
+                (
+                    (
+                        received,
+                        message['$schemaRef'],
+                        message['header'].get('softwareName'),
+                        message['header'].get('softwareVersion'),
+                        message['header'].get('uploaderID'),
+                        message['message'].get('systemName', message['message'].get('StarSystem')),  # NOQA
+                        message['message'].get('stationName', message['message'].get('StationName')),  # NOQA
+                        message['message'].get('timestamp'),
+                        simplejson.dumps(message),
+                    )
+                    for message in messages
+                )
+            )
+
+    def teardown(self):
+        if self.db is not None:
+            self.db.close()
+            self.db = None
@@ -0,0 +1,99 @@
+"""
+Post EDDN messages to a stand-in gateway on localhost and check what
+arrives.
+
+"""
+
+import gzip
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import json
+import threading
+import unittest
+
+import eddn.eddn as eddn
+
+
+class Gateway(BaseHTTPRequestHandler):
+    '''
+    Accept every upload and keep its headers and body.
+    '''
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers['Content-Length']))
+        self.server.received.append((dict(self.headers), body))
+        self.send_response(200)
+        self.send_header('Content-Length', '2')
+        self.end_headers()
+        self.wfile.write(b'OK')
+
+    def log_message(self, format, *args):
+        pass
+
+
+class CompressTest(unittest.TestCase):
+
+    def setUp(self):
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), Gateway)
+        self.server.received = []
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+        self.con = eddn.EDDN('test', True, 'EDAPI', 'test', compress=1024)
+        self.con._debug = False
+        self.con._gateways = (
+            'http://127.0.0.1:{}/upload/'.format(self.server.server_port),
+        )
+        # Keep proxies from the environment away from localhost.
+        self.con.session.trust_env = False
+
+    def tearDown(self):
+        self.con.close()
+        self.server.shutdown()
+        self.server.server_close()
+
+    def received(self):
+        self.assertEqual(len(self.server.received), 1)
+        headers, body = self.server.received[0]
+        headers = {key.lower(): value for key, value in headers.items()}
+        return headers, body
+
+    def test_large_body_is_gzipped(self):
+        commodities = [
+            {
+                'name': 'Commodity{}'.format(i),
+                'meanPrice': 1000 + i,
+                'buyPrice': 900 + i,
+                'stock': 5000,
+                'stockBracket': 2,
+                'sellPrice': 1100 + i,
+                'demand': 1,
+                'demandBracket': '',
+            }
+            for i in range(50)
+        ]
+        self.con.publishCommodities(
+            'Lave',
+            'Lave Station é',
+            commodities,
+            [],
+            []
+        )
+
+        headers, body = self.received()
+        self.assertEqual(headers.get('content-encoding'), 'gzip')
+        message = json.loads(gzip.decompress(body).decode('utf8'))
+        self.assertEqual(message['message']['stationName'], 'Lave Station é')  # NOQA
+        self.assertEqual(message['message']['commodities'], commodities)
+        self.assertLess(len(body), self.con.stats['bytes'])
+        self.assertEqual(self.con.stats['bytesSent'], len(body))
+
+    def test_small_body_is_plain(self):
+        self.con.publishShipyard('Lave', 'Lave Station', ['Eagle'])
+
+        headers, body = self.received()
+        self.assertNotIn('content-encoding', headers)
+        message = json.loads(body.decode('utf8'))
+        self.assertEqual(message['message']['ships'], ['Eagle'])
+
+
+if __name__ == '__main__':
+    unittest.main()
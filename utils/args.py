@@ -65,6 +65,106 @@ def parse_args(version):
                         help="Post price, shipyards, and outfitting to the \
                         EDDN.")
 
+    # EDDN duplicate window
+    parser.add_argument("--eddn-window",
+                        metavar="SECONDS",
+                        default=3600,
+                        type=int,
+                        help="Don't post a message to the EDDN if the same\
+                        one was posted for the station within this many\
+                        seconds. Use 0 to always post.")
+
+    # EDDN workers
+    parser.add_argument("--eddn-workers",
+                        metavar="N",
+                        default=3,
+                        type=int,
+                        help="Number of messages posted to the EDDN at the\
+                        same time in the background. Use 0 to post one at a\
+                        time.")
+
+    # EDDN compression
+    parser.add_argument("--eddn-compress",
+                        metavar="BYTES",
+                        default=1024,
+                        type=int,
+                        help="Gzip messages to the EDDN of at least this many\
+                        bytes. Use 0 to never compress.")
+
+    # Replay the outbox
+    parser.add_argument("--replay-outbox",
+                        action="store_true",
+                        default=False,
+                        help="Post the messages that could not be posted to\
+                        the EDDN earlier, then exit.")
+
+    # Replay rate
+    parser.add_argument("--replay-rate",
+                        metavar="RATE",
+                        default=2.0,
+                        type=float,
+                        help="Messages per second posted when replaying the\
+                        outbox.")
+
+    # Changed markets only
+    parser.add_argument("--changed-only",
+                        action="store_true",
+                        default=False,
+                        help="Compare the market with the last one seen for\
+                        the station, and only post it to the EDDN if it\
+                        changed.")
+
+    # Price history
+    parser.add_argument("--history",
+                        metavar="FILE",
+                        default=None,
+                        help="Record the market prices in this SQLite file.")
+
+    # Price history queries
+    parser.add_argument("--query",
+                        choices=("latest", "history", "best"),
+                        default=None,
+                        help="Instead of normal import, print the latest\
+                        prices, the price history, or the best places to buy\
+                        and sell --commodity from the --history file.")
+
+    # Commodity
+    parser.add_argument("--commodity",
+                        metavar="NAME",
+                        default=None,
+                        help="Used with --query. Commodity name.")
+
+    # Bulk import
+    parser.add_argument("--bulk",
+                        metavar="PATH",
+                        nargs="+",
+                        default=None,
+                        help="Process saved API responses instead of the\
+                        API. Takes directories or glob patterns.")
+
+    # Bulk sink
+    parser.add_argument("--bulk-sink",
+                        choices=("jsonl", "eddn", "outbox", "history"),
+                        default="jsonl",
+                        help="Used with --bulk. Write the stations to a JSON\
+                        lines file, post them to the EDDN, only journal\
+                        them in the outbox for --replay-outbox, or record\
+                        them in the --history file.")
+
+    # Bulk output
+    parser.add_argument("--bulk-output",
+                        metavar="FILE",
+                        default="stations.jsonl",
+                        help="Used with --bulk-sink jsonl. Output file.")
+
+    # Processes
+    parser.add_argument("--jobs",
+                        metavar="N",
+                        default=None,
+                        type=int,
+                        help="Used with --bulk. Number of processes, defaults\
+                        to the number of CPUs.")
+
     # keys
     parser.add_argument("--keys",
                         action="append",
@@ -92,6 +192,27 @@ def parse_args(version):
                         help="Clear any cached user login cookies and force\
                         login. (Doesn't clear the machine token)")
 
+    # Sequential fetch
+    parser.add_argument("--sequential",
+                        action="store_true",
+                        default=False,
+                        help="Fetch /market and /shipyard one after the\
+                        other instead of at the same time.")
+
+    # Daemon
+    parser.add_argument("--daemon",
+                        action="store_true",
+                        default=False,
+                        help="Keep running and poll the API, processing the\
+                        station whenever it changed.")
+
+    # Polling interval
+    parser.add_argument("--interval",
+                        metavar="SECONDS",
+                        default=60,
+                        type=int,
+                        help="Used with --daemon. Seconds between polls.")
+
     # Parse the command line.
     args = parser.parse_args()
 